@@ -0,0 +1,122 @@
+"""The read-only JSON API (/api/<category_id>/items/, /api/<item_id>/item/
+and /api/all/) as a tier of its own in front of the Flask app, for gevent
+workers: CATALOG_API_TIER=1 gunicorn -k gevent wsgi:app.
+
+Under gevent every request is a greenlet, so a worker can keep thousands of
+API connections open while they wait on the database, instead of tying up
+one of a few threads each. psycopg2 is made to yield to the other greenlets
+while it waits on PostgreSQL, and the API gets connection pools of its own,
+to the primary and to every replica, so that a burst of API requests does
+not starve the pages. SQLite blocks the worker and is only meant for
+testing.
+
+The requests are still handled by the app's views, so they read from the
+replica route_reads picks, show up in the metrics and answer exactly like
+the Flask views do, ETags included."""
+from werkzeug.exceptions import NotFound
+from werkzeug.routing import Map, Rule
+import catalog
+
+try:
+    from gevent import monkey
+    from gevent.socket import wait_read, wait_write
+except ImportError:
+    monkey = None
+
+try:
+    import psycopg2.extensions
+except ImportError:
+    psycopg2 = None
+
+
+url_map = Map([
+    Rule('/api/<int:category_id>/items/', endpoint='items', methods=['GET']),
+    Rule('/api/<int:item_id>/item/', endpoint='item', methods=['GET']),
+    Rule('/api/all/', endpoint='all', methods=['GET'])
+])
+
+
+def wait_callback(connection, timeout=None):
+    """Waits for psycopg2 by letting the other greenlets run."""
+    while True:
+        state = connection.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        elif state == psycopg2.extensions.POLL_READ:
+            wait_read(connection.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            wait_write(connection.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError('Bad poll state: %r' % state)
+
+
+def make_green():
+    """Makes psycopg2 cooperative if gevent has patched the process, as the
+    gevent workers do. Returns whether it did."""
+    if monkey is None or psycopg2 is None or \
+            not monkey.is_module_patched('socket'):
+        return False
+
+    psycopg2.extensions.set_wait_callback(wait_callback)
+    return True
+
+
+def is_api_request(environ):
+    """Returns whether the request is one the API tier serves."""
+    adapter = url_map.bind_to_environ(environ)
+    return adapter.test(environ.get('PATH_INFO') or '/',
+                        environ.get('REQUEST_METHOD', 'GET'))
+
+
+class ApiTier(object):
+    """Serves the read-only API through the request handling of the Flask
+    app, but on database pools of its own."""
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.green = catalog.PerProcess(make_green)
+        self._engines = catalog.PerProcess(self.make_engines)
+
+    def make_engines(self):
+        config = self.app.config
+        return catalog.make_engines(dict(
+            config, DB_POOL_SIZE=config['API_DB_POOL_SIZE'],
+            DB_MAX_OVERFLOW=config['API_DB_MAX_OVERFLOW']))
+
+    @property
+    def engines(self):
+        """Returns the API's (primary, replicas) engines of the current
+        process, making them first if needed."""
+        return self._engines.get()
+
+    def __call__(self, environ, start_response):
+        """Serves the API on its own, answering 404 to anything else."""
+        self.green.get()
+        if not is_api_request(environ):
+            return NotFound()(environ, start_response)
+
+        environ[catalog.ENGINES_ENVIRON_KEY] = self.engines
+        return self.wsgi_app(environ, start_response)
+
+
+def mount(app):
+    """Has the API tier answer the requests of the app that it has a route
+    for, leaving every other request to the app's own pools. Returns the
+    tier.
+
+    psycopg2 is made cooperative once per process: here, and again on the
+    first request of every worker, since a preloaded app is mounted before
+    the workers are forked and gevent patches them."""
+    tier = ApiTier(app)
+    tier.green.get()
+    wsgi_app = app.wsgi_app
+
+    def dispatch(environ, start_response):
+        tier.green.get()
+        if is_api_request(environ):
+            return tier(environ, start_response)
+        return wsgi_app(environ, start_response)
+
+    app.wsgi_app = dispatch
+    return tier
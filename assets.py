@@ -0,0 +1,176 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import zlib
+from io import BytesIO
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+"""Files worth compressing ahead of time. Images are already compressed."""
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+
+"""Precompressed variants, in order of preference, as (encoding, suffix)."""
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+"""Name of the file the fingerprints are written to at deploy time."""
+MANIFEST = 'manifest.json'
+
+"""Uploaded images are already named by the SHA-256 of their content."""
+CONTENT_ADDRESSED = re.compile(r'(^|/)([0-9a-f]{64})(-\w+)?\.\w+$')
+
+
+def fingerprint_file(path):
+    """Returns a short hash of the file's content."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def static_files(folder):
+    """Generates the (filename, path) of every file in the static folder,
+    leaving out the manifest and the precompressed variants."""
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, folder).replace(os.sep, '/')
+            if filename == MANIFEST or \
+                    filename.endswith(tuple(s for _, s in ENCODINGS)):
+                continue
+            yield filename, path
+
+
+class StaticAssets(object):
+    """Fingerprints the files in the static folder and picks the best
+    precompressed variant of a file for a request. Fingerprints come from
+    the manifest written by build() when there is one, and are otherwise
+    worked out on first use and kept until the file changes."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.manifest = {}
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+        manifest_path = os.path.join(folder, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def fingerprint(self, filename):
+        """Returns the fingerprint of the static file or None if there is no
+        such file."""
+        if filename in self.manifest:
+            return self.manifest[filename]
+
+        match = CONTENT_ADDRESSED.search(filename)
+        if match:
+            return match.group(2)[:12] + (match.group(3) or '')
+
+        path = os.path.join(self.folder, filename)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+
+        cached = self.hashes.get(filename)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        version = fingerprint_file(path)
+        with self.lock:
+            self.hashes[filename] = (mtime, version)
+        return version
+
+    def digest(self):
+        """Returns a digest of the fingerprints of every static file but
+        the uploaded images, which changes whenever a deploy changes any of
+        the files the pages link to."""
+        digest = hashlib.sha1()
+        for filename, path in sorted(static_files(self.folder)):
+            if not CONTENT_ADDRESSED.search(filename):
+                digest.update('%s=%s\n' % (filename,
+                                           self.fingerprint(filename)))
+        return digest.hexdigest()
+
+    def encoded(self, filename, accept_encodings):
+        """Returns the (filename, encoding) of the file to send for the
+        static file, given the encodings the client accepts. The encoding is
+        None for the file itself. Variants older than the file are
+        ignored."""
+        if not filename.endswith(COMPRESSIBLE):
+            return filename, None
+
+        path = os.path.join(self.folder, filename)
+        for encoding, suffix in ENCODINGS:
+            if encoding not in accept_encodings:
+                continue
+            try:
+                if os.path.getmtime(path + suffix) >= \
+                        os.path.getmtime(path):
+                    return filename + suffix, encoding
+            except OSError:
+                pass
+
+        return filename, None
+
+
+def build(folder):
+    """Writes the gzip (and, with the brotli module installed, brotli)
+    variants of every compressible static file and the manifest of all the
+    fingerprints. Meant to be run at deploy time. Returns the number of
+    files fingerprinted."""
+    manifest = {}
+    for filename, path in list(static_files(folder)):
+        manifest[filename] = fingerprint_file(path)
+        if not filename.endswith(COMPRESSIBLE):
+            continue
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip_bytes(data, 9))
+        if brotli is not None:
+            with open(path + '.br', 'wb') as f:
+                f.write(brotli.compress(data))
+
+    with open(os.path.join(folder, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return len(manifest)
+
+
+def gzip_bytes(data, level=6):
+    """Returns the data gzip compressed."""
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level,
+                       mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def gzip_stream(chunks, level=6):
+    """Gzip compresses an iterable of chunks as it is consumed, flushing
+    after every chunk so the client gets each one as soon as it is ready."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk) + \
+                compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
@@ -0,0 +1,464 @@
+"""Route level benchmark for the catalog app.
+
+Seeds a scratch database with a catalog of the requested size, drives every
+route in catalog.py through the Flask test client from several threads and
+reports throughput, latency percentiles and SQL statements per request.
+
+    python benchmark.py run --database-url sqlite:////tmp/bench.db \\
+        --output before.json
+    python benchmark.py compare before.json after.json --threshold 10
+
+The database given to run is wiped first, so never point it at real data.
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urlparse import urlparse
+from Queue import Queue, Empty
+
+
+"""CSRF token put in the session of the benchmark user and in every form
+it posts."""
+BENCH_CSRF_TOKEN = 'benchmark'
+
+
+def percentile(sorted_values, fraction):
+    """Returns the nearest rank percentile of the sorted values."""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(math.ceil(fraction * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def prepare_app(database_url, directory):
+    """Returns a catalog app on the scratch database, which is wiped and
+    created anew. Its sessions and template cache go in the directory."""
+    from catalog import create_app, get_resources
+    from database_setup import Base, create_schema
+    if database_url.startswith('sqlite:///'):
+        path = database_url[len('sqlite:///'):]
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    app = create_app({
+        'DATABASE_URL': database_url,
+        'SESSION_STORE': os.path.join(directory, 'sessions.db'),
+        'TEMPLATE_CACHE_DIR': os.path.join(directory, 'template_cache'),
+        'SECRET_KEY': 'benchmark'
+    })
+    engine = get_resources(app).engine
+    if not database_url.startswith('sqlite'):
+        Base.metadata.drop_all(engine)
+    create_schema(engine)
+    return app
+
+
+def seed(engine, categories, items, users):
+    """Fills the database with users, categories and items per category.
+    Returns the ids the routes pick from."""
+    from database_setup import User, Category, Item
+    engine.execute(User.__table__.insert(), [
+        {'name': 'Bench User %i' % i, 'email': 'bench%i@example.com' % i,
+         'picture': 'https://example.com/%i.png' % i}
+        for i in range(users)])
+    user_ids = [row[0] for row in engine.execute(
+        User.__table__.select().with_only_columns([User.id]))]
+
+    engine.execute(Category.__table__.insert(), [
+        {'name': 'Category %i' % i, 'user_id': user_ids[0],
+         'item_count': items} for i in range(categories)])
+    category_ids = [row[0] for row in engine.execute(
+        Category.__table__.select().with_only_columns([Category.id]))]
+
+    rows = []
+    for category_id in category_ids:
+        for i in range(items):
+            rows.append({
+                'title': 'Item %i of %i' % (i, category_id),
+                'description': 'A benchmark ball used in sport number %i, '
+                               'with some words to search for.' % i,
+                'category_id': category_id,
+                'user_id': user_ids[i % len(user_ids)]
+            })
+            if len(rows) >= 1000:
+                engine.execute(Item.__table__.insert(), rows)
+                rows = []
+    if rows:
+        engine.execute(Item.__table__.insert(), rows)
+
+    item_ids = [row[0] for row in engine.execute(
+        Item.__table__.select().with_only_columns([Item.id]).where(
+            Item.user_id == user_ids[0]))]
+    return {
+        'user_id': user_ids[0],
+        'category_ids': category_ids,
+        'item_ids': item_ids
+    }
+
+
+def make_scratch(app, ids, count):
+    """Adds count scratch categories holding two items each, owned by the
+    benchmark user, for delete_item and delete_category to use up."""
+    from catalog import get_resources
+    from database_setup import Category, Item
+    engine = get_resources(app).engine
+    categories, items = Queue(), Queue()
+    for i in range(count):
+        category_id = engine.execute(Category.__table__.insert(), {
+            'name': 'Scratch %i' % i, 'user_id': ids['user_id'],
+            'item_count': 2}).inserted_primary_key[0]
+        categories.put(category_id)
+        for j in range(2):
+            items.put(engine.execute(Item.__table__.insert(), {
+                'title': 'Scratch %i' % j, 'description': 'scratch',
+                'category_id': category_id,
+                'user_id': ids['user_id']}).inserted_primary_key[0])
+    get_resources(app).category_cache.invalidate()
+    return categories, items
+
+
+def pick(values, n):
+    return values[n % len(values)]
+
+
+def succeeded(response, url):
+    """Tells whether a read went through. Reads fail with an error
+    status."""
+    return response.status_code < 400
+
+
+def redirects_to(path, code=302):
+    """Returns a check that a write redirected to path with code. The
+    write routes redirect on failure too: to a video on a bad CSRF token
+    and back to the form on bad input."""
+    def check(response, url):
+        return response.status_code == code and \
+            urlparse(response.headers.get('Location', '')).path == path
+    return check
+
+
+def build_routes(engine, ids, scratch_categories, scratch_items):
+    """Returns (name, method, url, data, check) for every route. url and
+    data build the request from its number, check tells from the response
+    and the url whether the request did what it should."""
+    from sqlalchemy import select, func
+    from database_setup import Item
+    categories = ids['category_ids']
+    items = ids['item_ids']
+
+    def form(n, **values):
+        values['csrf_token'] = BENCH_CSRF_TOKEN
+        return values
+
+    def take(queue):
+        try:
+            return queue.get_nowait()
+        except Empty:
+            return 0
+
+    def imported(count):
+        def check(response, url):
+            return response.status_code == 200 and \
+                json.loads(response.data)['imported'] == count
+        return check
+
+    def item_deleted(response, url):
+        """delete_item redirects to the index whether it worked or not."""
+        item_id = int(url.split('/')[2])
+        return redirects_to('/')(response, url) and not engine.execute(
+            select([func.count(Item.id)]).where(Item.id == item_id)).scalar()
+
+    return [
+        ('index', 'GET', lambda n: '/', None, succeeded),
+        ('show_category', 'GET',
+         lambda n: '/category/%i/items/' % pick(categories, n), None,
+         succeeded),
+        ('show_category_page', 'GET',
+         lambda n: '/category/%i/items/?limit=20' % pick(categories, n),
+         None, succeeded),
+        ('show_item', 'GET', lambda n: '/item/%i/' % pick(items, n), None,
+         succeeded),
+        ('search', 'GET', lambda n: '/search?q=ball+%i' % (n % 50), None,
+         succeeded),
+        ('login', 'GET', lambda n: '/login/', None, succeeded),
+        ('json_items', 'GET',
+         lambda n: '/api/%i/items/' % pick(categories, n), None, succeeded),
+        ('json_items_page', 'GET',
+         lambda n: '/api/%i/items/?limit=20' % pick(categories, n), None,
+         succeeded),
+        ('json_item', 'GET', lambda n: '/api/%i/item/' % pick(items, n),
+         None, succeeded),
+        ('json_items_batch', 'GET', lambda n: '/api/items?ids=%s' % ','.join(
+            str(pick(items, n + i)) for i in range(20)), None, succeeded),
+        ('json_all', 'GET', lambda n: '/api/all/', None, succeeded),
+        ('json_search', 'GET', lambda n: '/api/search?q=sport+%i' % (n % 50),
+         None, succeeded),
+        ('json_changes', 'GET', lambda n: '/api/changes?since=0', None,
+         succeeded),
+        ('json_export', 'GET', lambda n: '/api/export?category_id=%i' %
+         pick(categories, n), None, succeeded),
+        ('metrics', 'GET', lambda n: '/metrics', None, succeeded),
+        ('new_category_form', 'GET', lambda n: '/category/new/', None,
+         succeeded),
+        ('new_item_form', 'GET', lambda n: '/item/new/', None, succeeded),
+        ('edit_item_form', 'GET',
+         lambda n: '/item/%i/edit/' % pick(items, n), None, succeeded),
+        ('new_category', 'POST', lambda n: '/category/new/',
+         lambda n: form(n, name='New category %i' % n),
+         redirects_to('/', code=301)),
+        ('new_item', 'POST', lambda n: '/item/new/',
+         lambda n: form(n, title='New item %i' % n, description='new',
+                        category=str(pick(categories, n))),
+         redirects_to('/')),
+        ('edit_item', 'POST', lambda n: '/item/%i/edit/' % pick(items, n),
+         lambda n: form(n, title='Edited item %i' % n, description='edited',
+                        category=str(pick(categories, n))),
+         redirects_to('/')),
+        ('json_import', 'POST', lambda n: '/api/import',
+         lambda n: '\n'.join(json.dumps({
+             'title': 'Imported %i.%i' % (n, i), 'description': 'imported',
+             'category_id': pick(categories, n + i)}) for i in range(50)),
+         imported(50)),
+        ('delete_item', 'POST',
+         lambda n: '/item/%i/delete' % take(scratch_items), None,
+         item_deleted),
+        ('delete_category', 'POST',
+         lambda n: '/category/%i/delete' % take(scratch_categories), None,
+         redirects_to('/', code=301)),
+    ]
+
+
+def log_in(client, user_id):
+    """Stubs out the Google login by writing the session it would leave."""
+    with client.session_transaction() as session:
+        session['username'] = 'Bench User 0'
+        session['email'] = 'bench0@example.com'
+        session['picture'] = 'https://example.com/0.png'
+        session['user_id'] = user_id
+        session['csrf_token'] = BENCH_CSRF_TOKEN
+
+
+def count_statements(engine):
+    """Returns a thread local whose statements attribute counts the SQL
+    statements run by the current thread."""
+    from sqlalchemy import event
+    counter = threading.local()
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_statement(*args):
+        counter.statements = getattr(counter, 'statements', 0) + 1
+
+    return counter
+
+
+def run_route(app, counter, user_id, route, requests, concurrency,
+              warmup):
+    """Makes the requests to the route from concurrency threads and returns
+    its results."""
+    name, method, url, data, check = route
+    numbers = Queue()
+    for n in range(warmup + requests):
+        numbers.put(n)
+
+    latencies, statements, errors = [], [], [0]
+    lock = threading.Lock()
+
+    def worker():
+        client = app.test_client()
+        log_in(client, user_id)
+        while True:
+            try:
+                n = numbers.get_nowait()
+            except Empty:
+                return
+
+            """The csrf token is replaced by every form page, put it back."""
+            if method == 'POST':
+                log_in(client, user_id)
+
+            path = url(n)
+            body = data(n) if data else None
+            counter.statements = 0
+            started = time.time()
+            response = client.open(
+                path, method=method, data=body,
+                headers={'X-CSRF-Token': BENCH_CSRF_TOKEN},
+                content_type='application/json'
+                if isinstance(body, basestring) else None)
+            response.data
+            elapsed = time.time() - started
+            request_statements = counter.statements
+
+            if n < warmup:
+                continue
+            failed = not check(response, path)
+            with lock:
+                latencies.append(elapsed * 1000)
+                statements.append(request_statements)
+                if failed:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput_rps': round(len(latencies) / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'queries_per_request': round(
+            float(sum(statements)) / max(len(statements), 1), 2)
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.realpath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def command_run(args):
+    directory = tempfile.mkdtemp()
+    try:
+        return run(args, directory)
+    finally:
+        shutil.rmtree(directory)
+
+
+def run(args, directory):
+    from catalog import get_resources
+    app = prepare_app(args.database_url, directory)
+    engine = get_resources(app).engine
+    print >> sys.stderr, 'Seeding %i categories x %i items, %i users...' % (
+        args.categories, args.items, args.users)
+    ids = seed(engine, args.categories, args.items, args.users)
+    scratch_categories, scratch_items = make_scratch(
+        app, ids, args.warmup + args.requests)
+
+    counter = count_statements(engine)
+    only = set(args.routes.split(',')) if args.routes else None
+    results = {}
+    for route in build_routes(engine, ids, scratch_categories,
+                              scratch_items):
+        if only is not None and route[0] not in only:
+            continue
+        results[route[0]] = result = run_route(
+            app, counter, ids['user_id'], route, args.requests,
+            args.concurrency, args.warmup)
+        print >> sys.stderr, '%-20s %8.1f req/s  p50 %8.2f ms  p95 %8.2f ms' \
+            '  p99 %8.2f ms  %5.1f queries  %i errors' % (
+                route[0], result['throughput_rps'], result['p50_ms'],
+                result['p95_ms'], result['p99_ms'],
+                result['queries_per_request'], result['errors'])
+
+    report = {
+        'commit': git_commit(),
+        'database': engine.dialect.name,
+        'categories': args.categories,
+        'items': args.items,
+        'users': args.users,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'routes': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+
+def compare(before, after, threshold):
+    """Returns the (route, metric, before, after, change %) regressions of
+    more than threshold percent between two benchmark reports."""
+    regressions = []
+    for route, new in sorted(after['routes'].items()):
+        old = before['routes'].get(route)
+        if old is None:
+            continue
+
+        for metric, lower_is_better in [('p50_ms', True), ('p95_ms', True),
+                                        ('p99_ms', True),
+                                        ('throughput_rps', False),
+                                        ('queries_per_request', True)]:
+            if not old[metric]:
+                continue
+            change = (new[metric] - old[metric]) * 100.0 / old[metric]
+            if (change if lower_is_better else -change) > threshold:
+                regressions.append((route, metric, old[metric], new[metric],
+                                    change))
+    return regressions
+
+
+def command_compare(args):
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    for key in ['categories', 'items', 'users', 'concurrency', 'database']:
+        if before.get(key) != after.get(key):
+            print 'Warning: %s differs (%s vs %s), results may not be ' \
+                'comparable.' % (key, before.get(key), after.get(key))
+
+    regressions = compare(before, after, args.threshold)
+    for route, metric, old, new, change in regressions:
+        print '%-20s %-20s %10.2f -> %10.2f (%+.1f%%)' % (
+            route, metric, old, new, change)
+
+    if not regressions:
+        print 'No regressions over %g%%.' % args.threshold
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Catalog benchmark.')
+    commands = parser.add_subparsers()
+
+    run = commands.add_parser('run', help='benchmark every route')
+    run.add_argument('--database-url', required=True,
+                     help='scratch database to seed, it is wiped first')
+    run.add_argument('--categories', type=int, default=20)
+    run.add_argument('--items', type=int, default=100,
+                     help='items per category')
+    run.add_argument('--users', type=int, default=5)
+    run.add_argument('--requests', type=int, default=200,
+                     help='measured requests per route')
+    run.add_argument('--warmup', type=int, default=10,
+                     help='requests per route made before measuring')
+    run.add_argument('--concurrency', type=int, default=4)
+    run.add_argument('--routes', help='comma separated routes to run')
+    run.add_argument('--output', default='benchmark.json')
+    run.set_defaults(func=command_run)
+
+    compare_parser = commands.add_parser(
+        'compare', help='flag regressions between two runs')
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--threshold', type=float, default=10.0,
+                                help='percent change that counts as a '
+                                     'regression')
+    compare_parser.set_defaults(func=command_compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
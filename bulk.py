@@ -0,0 +1,163 @@
+"""Bulk import and export of items as NDJSON, one JSON object per line."""
+import json
+from collections import Counter
+from sqlalchemy import func
+from sqlalchemy.exc import SQLAlchemyError
+from database_setup import Category, Item
+from images import is_stored_name
+import changes
+
+
+"""Rows inserted, and committed, together by import_items."""
+IMPORT_BATCH_SIZE = 1000
+
+"""Rows fetched from the server side cursor at a time by export_items."""
+EXPORT_BATCH_SIZE = 1000
+
+"""Only this many row errors are listed in an import report. The rest are
+only counted."""
+MAX_REPORTED_ERRORS = 1000
+
+"""Columns of an exported item, in order."""
+EXPORT_COLUMNS = ['id', 'title', 'description', 'image_url', 'category_id',
+                  'user_id']
+
+
+def parse_row(line, category_ids):
+    """Returns the item values for an NDJSON line. Raises a ValueError
+    describing what is wrong with it otherwise."""
+    try:
+        data = json.loads(line)
+    except ValueError:
+        raise ValueError('not valid JSON')
+
+    if not isinstance(data, dict):
+        raise ValueError('expected a JSON object')
+
+    title = data.get('title')
+    if not isinstance(title, basestring) or not title.strip():
+        raise ValueError('title is required')
+    if len(title) > Item.title.property.columns[0].type.length:
+        raise ValueError('title is too long')
+
+    description = data.get('description')
+    if not isinstance(description, basestring):
+        raise ValueError('description is required')
+
+    category_id = data.get('category_id')
+    if isinstance(category_id, bool) or category_id not in category_ids:
+        raise ValueError('category_id %r does not exist' % (category_id,))
+
+    image_url = data.get('image_url')
+    if image_url is not None and not (isinstance(image_url, basestring) and
+                                      is_stored_name(image_url)):
+        raise ValueError('image_url must be the name of an uploaded image')
+
+    return {
+        'title': title.strip(),
+        'description': description,
+        'category_id': category_id,
+        'image_url': image_url
+    }
+
+
+class ImportReport(object):
+    """Outcome of an import: how many items went in and what was wrong with
+    the lines that did not."""
+
+    def __init__(self):
+        self.imported = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, line_number, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line_number, 'error': message})
+
+    def serialize(self):
+        """Serializes the report for json dumps."""
+        return {
+            'imported': self.imported,
+            'error_count': self.error_count,
+            'errors': self.errors
+        }
+
+
+def insert_batch(session, rows, report):
+    """Inserts the (line_number, values) rows with one executemany and
+    commits them, along with the item counts of their categories. If the
+    batch fails as a whole, its rows are inserted one by one so the failing
+    ones can be reported."""
+    if not rows:
+        return
+
+    try:
+        """executemany does not hand back the new ids, but they all come
+        after the largest id before the insert."""
+        last_id = session.query(func.max(Item.id)).scalar() or 0
+        user_id = rows[0][1]['user_id']
+        session.execute(Item.__table__.insert(),
+                        [values for _, values in rows])
+        changes.record_item_changes(
+            session, (Item.id > last_id) & (Item.user_id == user_id),
+            changes.UPSERT)
+        counts = Counter(values['category_id'] for _, values in rows)
+        for category_id, count in sorted(counts.items()):
+            session.query(Category).filter_by(id=category_id).update(
+                {Category.item_count: Category.item_count + count},
+                synchronize_session=False)
+        session.commit()
+
+    except SQLAlchemyError:
+        session.rollback()
+        if len(rows) == 1:
+            report.add_error(rows[0][0], 'could not be inserted')
+            return
+        for row in rows:
+            insert_batch(session, [row], report)
+        return
+
+    report.imported += len(rows)
+
+
+def import_items(session, lines, user_id, batch_size=IMPORT_BATCH_SIZE):
+    """Imports the items on the NDJSON lines as owned by the user, in
+    batches that are committed one at a time. Blank lines are skipped.
+    Returns an ImportReport."""
+    category_ids = set(category_id for (category_id,) in
+                       session.query(Category.id))
+    report = ImportReport()
+    rows = []
+
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+
+        try:
+            values = parse_row(line, category_ids)
+        except ValueError as e:
+            report.add_error(line_number, str(e))
+            continue
+
+        values['user_id'] = user_id
+        rows.append((line_number, values))
+        if len(rows) >= batch_size:
+            insert_batch(session, rows, report)
+            rows = []
+
+    insert_batch(session, rows, report)
+    return report
+
+
+def export_items(session, category_id=None):
+    """Generates every item, or every item of the category, as an NDJSON
+    line in id order. The rows are read through a server side cursor a
+    batch at a time, so the table is never loaded as a whole."""
+    query = session.query(*[getattr(Item, column)
+                            for column in EXPORT_COLUMNS])
+    if category_id is not None:
+        query = query.filter(Item.category_id == category_id)
+
+    for row in query.order_by(Item.id).yield_per(EXPORT_BATCH_SIZE):
+        yield json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n'
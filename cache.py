@@ -0,0 +1,225 @@
+import threading
+import time
+from collections import namedtuple
+
+
+"""Plain copy of a category row that can be shared between requests, unlike
+the session bound Category objects."""
+CachedCategory = namedtuple('CachedCategory',
+                            ['id', 'name', 'user_id', 'item_count'])
+
+"""Plain copy of an item row, with the name of its category, as listed in
+the latest items feed."""
+CachedItem = namedtuple('CachedItem', ['id', 'title', 'image_url',
+                                       'category_id', 'category_name'])
+
+
+class LocalBackend(object):
+    """Keeps the cache generation in process memory. Good enough for a single
+    worker and as a stand-in for the shared backend in tests. Generations
+    start from the time the backend was created, so they do not repeat after
+    a restart."""
+
+    def __init__(self):
+        self.generations = {}
+        self.start = int(time.time() * 1000)
+        self.lock = threading.Lock()
+
+    def get_generation(self, key):
+        """Returns the current generation for the key."""
+        return self.generations.get(key, self.start)
+
+    def bump_generation(self, key):
+        """Moves the key to a new generation, invalidating every copy of it.
+        Returns the new generation."""
+        with self.lock:
+            generation = self.generations.get(key, self.start) + 1
+            self.generations[key] = generation
+            return generation
+
+
+class RedisBackend(object):
+    """Keeps the cache generation in redis, so that an invalidation done by
+    one worker is seen by all the others."""
+
+    def __init__(self, url, prefix='catalog:cache:'):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+
+    def get_generation(self, key):
+        """Returns the current generation for the key."""
+        return int(self.client.get(self.prefix + key) or 0)
+
+    def bump_generation(self, key):
+        """Moves the key to a new generation, invalidating every copy of it.
+        Returns the new generation."""
+        return self.client.incr(self.prefix + key)
+
+
+def make_backend(redis_url=None):
+    """Returns the redis backend if a redis url is given, or the in process
+    one otherwise."""
+    if redis_url:
+        return RedisBackend(redis_url)
+    return LocalBackend()
+
+
+class ReadThroughCache(object):
+    """Caches the value returned by loader in process memory. The value is
+    loaded again once it is older than ttl seconds or once the backend
+    reports a newer generation for key, which is what invalidate() does."""
+
+    def __init__(self, key, loader, ttl=300, backend=None):
+        self.key = key
+        self.loader = loader
+        self.ttl = ttl
+        self.backend = backend if backend is not None else LocalBackend()
+        self.lock = threading.Lock()
+        self.value = None
+        self.generation = None
+        self.loaded_at = 0
+
+    def get(self):
+        """Returns the cached value, loading it first if it is stale."""
+        generation = self.backend.get_generation(self.key)
+        if self.is_fresh(generation):
+            return self.value
+
+        with self.lock:
+            """Another thread may have reloaded it while we waited."""
+            if self.is_fresh(generation):
+                return self.value
+
+            value = self.loader()
+            self.value = value
+            self.generation = generation
+            self.loaded_at = time.time()
+            return value
+
+    def is_fresh(self, generation):
+        """Returns whether the cached value can still be served."""
+        return self.generation == generation and \
+            time.time() - self.loaded_at < self.ttl
+
+    def invalidate(self):
+        """Drops the cached value here and, through the backend, in every
+        other worker sharing it."""
+        with self.lock:
+            self.generation = None
+        self.backend.bump_generation(self.key)
+
+
+class LatestItems(object):
+    """Keeps the newest items, newest first, in process memory so listing
+    them needs no query. Writers update it in place after they commit, with
+    add, replace and remove. Other workers see the generation of key move on
+    and load the items again through loader(limit), as does this one after
+    invalidate(), once removals leave it with fewer than size items, or
+    once ttl seconds have passed since it last loaded them. Without a
+    shared backend the ttl is what brings other workers' writes in.
+
+    A few spare items are kept beyond size so that most removals do not
+    need a reload."""
+
+    def __init__(self, key, loader, size=20, spare=20, ttl=30, backend=None):
+        self.key = key
+        self.loader = loader
+        self.size = size
+        self.capacity = size + spare
+        self.ttl = ttl
+        self.backend = backend if backend is not None else LocalBackend()
+        self.lock = threading.Lock()
+        self.items = ()
+        self.complete = False
+        self.generation = None
+        self.loaded_at = 0
+
+    def get(self):
+        """Returns the newest size items, loading them first if needed."""
+        generation = self.backend.get_generation(self.key)
+        if not self.is_fresh(generation):
+            with self.lock:
+                if not self.is_fresh(generation):
+                    items = self.loader(self.capacity)
+                    self.items = tuple(items)
+                    self.complete = len(items) < self.capacity
+                    self.generation = generation
+                    self.loaded_at = time.time()
+        return self.items[:self.size]
+
+    def is_fresh(self, generation):
+        """Returns whether the items can still be served: no other worker
+        has changed them, they are younger than ttl and there are enough
+        left, or there are no more."""
+        return self.generation == generation and \
+            time.time() - self.loaded_at < self.ttl and \
+            (self.complete or len(self.items) >= self.size)
+
+    def change(self, update):
+        """Passes the items through update, a function from the old to the
+        new list, and tells the other workers to reload theirs. If this
+        worker missed another change since it last loaded, it reloads as
+        well instead."""
+        generation = self.backend.bump_generation(self.key)
+        with self.lock:
+            if self.generation is None or self.generation != generation - 1:
+                return
+
+            items = update(list(self.items))
+            if len(items) > self.capacity:
+                items = items[:self.capacity]
+                self.complete = False
+            self.items = tuple(items)
+            self.generation = generation
+
+    def add(self, item):
+        """Adds a new CachedItem. An item older than every listed one is
+        only added if nothing older is missing from the list. A reload that
+        ran after the item was committed may already list it, in which case
+        it is not listed twice."""
+        def update(items):
+            items = [listed for listed in items if listed.id != item.id]
+            if items and item.id < items[-1].id and not self.complete:
+                return items
+            return sorted(items + [item], key=lambda listed: listed.id,
+                          reverse=True)
+
+        self.change(update)
+
+    def replace(self, item):
+        """Replaces the CachedItem with the same id, if it is listed."""
+        self.change(lambda items: [item if listed.id == item.id else listed
+                                   for listed in items])
+
+    def remove(self, predicate):
+        """Removes the items the predicate is true for."""
+        self.change(lambda items: [item for item in items
+                                   if not predicate(item)])
+
+    def invalidate(self):
+        """Drops the items here and in every other worker sharing them."""
+        with self.lock:
+            self.generation = None
+        self.backend.bump_generation(self.key)
+
+
+class FragmentCache(object):
+    """Keeps rendered fragments of pages in process memory. A fragment is
+    rendered from one value and kept for as long as it is asked for with
+    that same object, which is what ReadThroughCache hands out until it
+    reloads, so it is never older than the cached value itself."""
+
+    def __init__(self):
+        self.fragments = {}
+
+    def get(self, key, value, render):
+        """Returns the fragment stored under key, calling render() to make
+        it again if it was rendered from another value."""
+        cached = self.fragments.get(key)
+        if cached is not None and cached[0] is value:
+            return cached[1]
+
+        fragment = render()
+        self.fragments[key] = (value, fragment)
+        return fragment
@@ -1,47 +1,732 @@
 from flask import Flask, render_template, url_for, request, redirect, flash, \
-    jsonify, make_response
-from sqlalchemy import create_engine, desc, func
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import sessionmaker
-from database_setup import Base, Item, Category, db_url, User
+    jsonify, make_response, Response, stream_with_context, \
+    send_from_directory
+from flask import g, has_request_context, current_app, _app_ctx_stack, \
+    Markup
+from functools import wraps, partial
+from contextlib import contextmanager
+from sqlalchemy import create_engine, desc, func, event, select
+from sqlalchemy.exc import IntegrityError, DisconnectionError
+from sqlalchemy.sql.expression import UpdateBase
+from sqlalchemy.orm import sessionmaker, scoped_session, joinedload, Session
+from werkzeug.local import LocalProxy
+from itertools import groupby
+from database_setup import Item, Category, User
+from cache import CachedCategory, CachedItem, ReadThroughCache, \
+    LatestItems, FragmentCache, make_backend
+from search import search_items, SearchTimeout
+from cleanup import FileCleaner
+from images import ImageProcessor, IMAGE_EXTENSIONS, store_upload
+from assets import StaticAssets, gzip_bytes, gzip_stream
+from bulk import import_items, export_items
+from serialization import item_columns, category_columns, item_dict, \
+    category_dict, negotiate, dumps, stream_list, MSGPACK
+import changes
+import metrics
+import google_auth
+import sessions
+import templating
 from flask import session as login_session
 import random
 import string
 from oauth2client.client import flow_from_clientsecrets
 from oauth2client.client import FlowExchangeError
-import httplib2
 import json
 import requests
 import os
+import base64
+import hashlib
+import mimetypes
+import threading
+import time
 
 
 """This is to validate the extension."""
-valid_ext = [
-    'png',
-    'jpg',
-    'jpeg',
-    'gif'
-]
+valid_ext = IMAGE_EXTENSIONS
+
+"""Number of item rows fetched from the cursor at a time by json_all."""
+STREAM_BATCH_SIZE = 500
+
+"""Stands for the category_id after the last group of items in
+catalog_blocks, where None would be taken for a real one."""
+_NO_MORE_ITEMS = object()
+
+"""Dynamic responses of these types larger than COMPRESS_MIN_SIZE bytes are
+gzip compressed for the clients that accept it."""
+COMPRESS_MIMETYPES = ('text/html', 'application/json',
+                      'application/x-ndjson', MSGPACK)
+COMPRESS_MIN_SIZE = 1024
+
+"""Fingerprinted static urls can be cached for as long as clients want,
+since a changed file gets a new url."""
+STATIC_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+"""Number of items listed under Latest Items on the home page."""
+LATEST_ITEMS = 20
+
+"""Largest page a client can ask for with the limit parameter."""
+MAX_PAGE_SIZE = 100
+
+"""Most items that can be fetched at once from /api/items."""
+MAX_BATCH_IDS = 100
+
+"""Content types /api/import accepts the NDJSON body as."""
+IMPORT_MIMETYPES = ['application/json', 'application/x-ndjson']
+
+"""Changes returned per page of /api/changes."""
+CHANGES_PAGE_SIZE = 500
+
+"""Number of search results per page. How long the database may spend on
+a search is set by SEARCH_BUDGET_MS."""
+SEARCH_PAGE_SIZE = 20
+
+"""Settings of the app and their defaults. create_app takes each one from
+the CATALOG_<NAME> environment variable if it is set (CATALOG_DATABASE_URL,
+CATALOG_DB_POOL_SIZE, ...) and then applies the config it is given on top.
+The DB_POOL_* settings size the connection pool to the worker threads of a
+deployment. REPLICA_URLS is a comma separated list of read replicas of the
+database, see AppSession. SESSION_STORE is the SQLite file, or the redis://
+url, that the login sessions are kept in, see sessions.py.
+TEMPLATE_CACHE_DIR is where the compiled templates are shared between
+workers, see templating.py; an empty one turns the cache off. API_TIER
+serves the read-only API through api.py, on pools of its own sized by
+API_DB_POOL_SIZE and API_DB_MAX_OVERFLOW."""
+DEFAULT_CONFIG = {
+    'DATABASE_URL': 'postgresql:///catalog',
+    'REPLICA_URLS': '',
+    'READ_YOUR_WRITES_SECONDS': 10,
+    'SECRET_KEY': None,
+    'SESSION_STORE': 'sessions.db',
+    'TEMPLATE_CACHE_DIR': 'template_cache',
+    'API_TIER': False,
+    'API_DB_POOL_SIZE': 20,
+    'API_DB_MAX_OVERFLOW': 0,
+    'DEBUG': False,
+    'HOST': '',
+    'PORT': 8080,
+    'CLIENT_SECRETS': 'client_secrets.json',
+    'OAUTH_TIMEOUT': 5.0,
+    'OAUTH_POOL_SIZE': 10,
+    'TOKENINFO_CACHE_TTL': 60,
+    'GOOGLE_TOKENINFO_URL': google_auth.TOKENINFO_URL,
+    'GOOGLE_USERINFO_URL': google_auth.USERINFO_URL,
+    'GOOGLE_REVOKE_URL': google_auth.REVOKE_URL,
+    'DB_POOL_SIZE': 5,
+    'DB_MAX_OVERFLOW': 10,
+    'DB_POOL_TIMEOUT': 30,
+    'DB_POOL_RECYCLE': 3600,
+    'DB_POOL_PRE_PING': True,
+    'CACHE_REDIS_URL': None,
+    'CATEGORY_CACHE_TTL': 300,
+    'LATEST_ITEMS_CACHE_TTL': 30,
+    'IMAGE_WORKERS': 2,
+    'SEARCH_BUDGET_MS': 250,
+    'SLOW_REQUEST_MS': 0,
+    'QUERY_BUDGET_RAISE': False
+}
+
+
+def config_from_env(environ=os.environ):
+    """Returns the settings of DEFAULT_CONFIG that are set in the
+    environment, converted to the type of their default."""
+    config = {}
+    for name, default in DEFAULT_CONFIG.items():
+        value = environ.get('CATALOG_' + name)
+        if value is None:
+            continue
+
+        if isinstance(default, bool):
+            value = value.lower() in ('1', 'true', 'yes', 'on')
+        elif isinstance(default, int):
+            value = int(value)
+        elif isinstance(default, float):
+            value = float(value)
+        config[name] = value
+
+    return config
+
+
+def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Checks that a pooled connection is still alive before it is handed
+    out, so a restarted database or a dropped connection does not fail the
+    request that happens to pick it up. Raising DisconnectionError makes the
+    pool throw the connection away and retry with a fresh one."""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+
+    except Exception:
+        raise DisconnectionError()
+
+    finally:
+        cursor.close()
+
+
+def record_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    """Keeps track of the statements run by a view under a query_budget."""
+    if has_request_context() and getattr(g, 'statements', None) is not None:
+        g.statements.append(statement)
+
+
+def make_engine(config, url):
+    """Returns a new engine for the database url, pooled as set by the
+    DB_POOL_* settings of the config."""
+    if url.startswith('sqlite'):
+        """SQLite (used for local testing and benchmarks) does not pool its
+        connections the same way, so it gets the default pool."""
+        engine = create_engine(url)
+    else:
+        engine = create_engine(url, pool_size=config['DB_POOL_SIZE'],
+                               max_overflow=config['DB_MAX_OVERFLOW'],
+                               pool_timeout=config['DB_POOL_TIMEOUT'],
+                               pool_recycle=config['DB_POOL_RECYCLE'])
+
+    if config['DB_POOL_PRE_PING']:
+        event.listen(engine.pool, 'checkout', ping_connection)
+    event.listen(engine, 'before_cursor_execute', record_statement)
+    metrics.instrument_engine(engine)
+    return engine
+
+
+def make_engines(config):
+    """Returns new (primary, replicas) engines for the DATABASE_URL and
+    REPLICA_URLS of the config."""
+    urls = config['REPLICA_URLS']
+    if isinstance(urls, basestring):
+        urls = [url.strip() for url in urls.split(',') if url.strip()]
+    return (make_engine(config, config['DATABASE_URL']),
+            [make_engine(config, url) for url in urls])
+
+
+class PerProcess(object):
+    """Holds what factory() returns, made on first use in every process,
+    so that a server that forks its workers after loading the app does not
+    share one copy, such as a pool of connections, between them."""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.value = None
+        self.pid = None
+
+    def get(self):
+        """Returns the value of the current process, making it first if
+        needed."""
+        pid = os.getpid()
+        if self.pid != pid:
+            with self.lock:
+                if self.pid != pid:
+                    self.value = self.factory()
+                    self.pid = pid
+        return self.value
+
+
+class Resources(object):
+    """The engines, caches and background workers of an app. Nothing here
+    connects or starts a thread before it is first used, so a pre-fork
+    server can preload the app and every worker still gets its own
+    connections. The engines are made again in every process that uses
+    them."""
+
+    def __init__(self, app):
+        self.app = app
+        self.client_id = None
+        self.metrics = None
+        self.engines = PerProcess(lambda: make_engines(app.config))
+
+        """Shared by the caches below. Setting CATALOG_CACHE_REDIS_URL
+        shares invalidations between workers."""
+        self.cache_backend = make_backend(app.config['CACHE_REDIS_URL'])
+
+        """Categories are listed on almost every page but hardly ever
+        change, so they are cached and invalidated by every handler that
+        writes a category or changes its item count. The ttl is only a
+        safety net."""
+        self.category_cache = ReadThroughCache(
+            'categories', load_categories,
+            ttl=app.config['CATEGORY_CACHE_TTL'], backend=self.cache_backend)
+
+        """The home page lists the newest items. Every handler that writes
+        an item updates them in place, so the home page needs no query. The
+        ttl bounds how long writes of other workers go unseen when there is
+        no redis to tell them."""
+        self.latest_items = LatestItems(
+            'latest_items', load_latest_items, size=LATEST_ITEMS,
+            ttl=app.config['LATEST_ITEMS_CACHE_TTL'],
+            backend=self.cache_backend)
+
+        """Rendered page fragments, such as the category list, kept until
+        the cached value they were rendered from changes."""
+        self.fragments = FragmentCache()
+
+        self.static_assets = StaticAssets(app.static_folder)
+        self._deploy_version = None
+
+        """Removes the image files of deleted items in the background,
+        after the deletion has been committed."""
+        self.image_cleaner = FileCleaner()
+
+        """Uploaded images are stored here under the hash of their content,
+        next to the resized variants the image_processor makes of them."""
+        self.images_path = os.path.join(app.static_folder, 'images')
+        self.image_processor = ImageProcessor(
+            self.images_path, workers=app.config['IMAGE_WORKERS'])
+
+        """Used by gconnect and gdisconnect. The GOOGLE_*_URL settings let
+        the login be tested against a local stand-in for Google."""
+        self.google = google_auth.GoogleClient(
+            timeout=app.config['OAUTH_TIMEOUT'],
+            pool_size=app.config['OAUTH_POOL_SIZE'],
+            tokeninfo_ttl=app.config['TOKENINFO_CACHE_TTL'],
+            tokeninfo_url=app.config['GOOGLE_TOKENINFO_URL'],
+            userinfo_url=app.config['GOOGLE_USERINFO_URL'],
+            revoke_url=app.config['GOOGLE_REVOKE_URL'])
+
+    def get_deploy_version(self):
+        """Returns a digest of the templates and static files the pages of
+        this process are rendered with. It is worked out once per process,
+        or on every use in debug mode, where changes to both are picked up
+        without a restart."""
+        if self._deploy_version is None or self.app.debug:
+            self._deploy_version = hashlib.sha1(
+                templating.source_digest(self.app) +
+                self.static_assets.digest()).hexdigest()
+        return self._deploy_version
+
+    def get_engines(self):
+        """Returns the (primary, replicas) engines of the current process,
+        making them first if needed."""
+        return self.engines.get()
+
+    @property
+    def engine(self):
+        """Returns the primary engine of the current process."""
+        return self.get_engines()[0]
+
+    @property
+    def replicas(self):
+        """Returns the replica engines of the current process."""
+        return self.get_engines()[1]
+
+
+def get_resources(app=None):
+    """Returns the Resources of the app, or of the current app."""
+    return (app or current_app).extensions['catalog']
+
+
+"""Key of the WSGI environ under which the API tier hands the requests it
+serves the (primary, replicas) engines of its own pools."""
+ENGINES_ENVIRON_KEY = 'catalog.engines'
+
+
+def get_engines():
+    """Returns the (primary, replicas) engines the current request runs
+    on: those of the API tier for the requests it serves, and those of the
+    current app otherwise."""
+    if has_request_context():
+        engines = request.environ.get(ENGINES_ENVIRON_KEY)
+        if engines is not None:
+            return engines
+    return get_resources().get_engines()
+
+
+class AppSession(Session):
+    """A session that runs its statements on the engines of the current
+    app, or of the API tier, see get_engines. Writes always go to the
+    primary. Reads go to the replica that route_reads picked for the
+    request, if any, and to the primary otherwise."""
+
+    def get_bind(self, mapper=None, clause=None):
+        request_context = has_request_context()
+        if self._flushing or isinstance(clause, UpdateBase):
+            if request_context:
+                g.wrote_to_primary = True
+            return get_engines()[0]
+
+        replica = getattr(g, 'replica', None) if request_context else None
+        return replica or get_engines()[0]
+
+
+def read_only(view):
+    """Marks a view that only reads, so its GET requests can be served from
+    a replica."""
+    view.read_only = True
+    return view
+
+
+def route_reads():
+    """Picks a replica for the reads of a GET request to a read_only view,
+    unless the user wrote something in the last READ_YOUR_WRITES_SECONDS.
+    That way users always see their own changes, even while the replicas
+    are lagging behind."""
+    replicas = get_engines()[1]
+    view = current_app.view_functions.get(request.endpoint)
+    if replicas and request.method in ('GET', 'HEAD') and \
+            getattr(view, 'read_only', False) and \
+            login_session.get('primary_until', 0) < time.time():
+        g.replica = random.choice(replicas)
+
+
+def remember_writes(response):
+    """Sends the reads of the user to the primary for the next
+    READ_YOUR_WRITES_SECONDS if the request wrote to it."""
+    if getattr(g, 'wrote_to_primary', False):
+        login_session['primary_until'] = \
+            time.time() + current_app.config['READ_YOUR_WRITES_SECONDS']
+    return response
+
+
+"""Every app context (and so every request) gets its own session, which is
+removed again when the context is torn down. This keeps one request's
+rollback() from touching another's work when running with threads."""
+session = scoped_session(sessionmaker(class_=AppSession),
+                         scopefunc=_app_ctx_stack.__ident_func__)
+
+"""The resources of the current app, under the names the views use."""
+cache_backend = LocalProxy(lambda: get_resources().cache_backend)
+category_cache = LocalProxy(lambda: get_resources().category_cache)
+latest_items = LocalProxy(lambda: get_resources().latest_items)
+fragments = LocalProxy(lambda: get_resources().fragments)
+static_assets = LocalProxy(lambda: get_resources().static_assets)
+image_cleaner = LocalProxy(lambda: get_resources().image_cleaner)
+image_processor = LocalProxy(lambda: get_resources().image_processor)
+
+"""The views of the app and their url rules, added to every app made by
+create_app."""
+url_rules = []
+
+
+def route(rule, **options):
+    """Like app.route, but records the view for create_app. The endpoint is
+    the name of the view, as with app.route."""
+    def decorator(view):
+        url_rules.append((rule, view, options))
+        return view
+
+    return decorator
+
+
+def get_client_id():
+    """Returns the Google client id, read from the app's CLIENT_SECRETS
+    file the first time it is needed."""
+    resources = get_resources()
+    if resources.client_id is None:
+        with open(current_app.config['CLIENT_SECRETS'], 'r') as f:
+            resources.client_id = json.load(f)['web']['client_id']
+    return resources.client_id
+
+
+@route('/metrics')
+def show_metrics():
+    """Returns the request metrics in the Prometheus text format."""
+    return Response(get_resources().metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def fingerprint_static_url(endpoint, values):
+    """Adds the fingerprint of the file to every url_for('static', ...)."""
+    if endpoint == 'static' and 'filename' in values:
+        version = static_assets.fingerprint(values['filename'])
+        if version is not None:
+            values['v'] = version
+
+
+def serve_static(filename):
+    """Serves a static file, or its precompressed variant if the client
+    accepts one. Fingerprinted urls are marked as never changing, so repeat
+    visits do not request them at all."""
+    name, encoding = static_assets.encoded(filename, request.accept_encodings)
+    response = send_from_directory(
+        current_app.static_folder, name,
+        mimetype=mimetypes.guess_type(filename)[0] or
+        'application/octet-stream')
+
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+
+    if 'v' in request.args:
+        response.headers['Cache-Control'] = STATIC_CACHE_CONTROL
+        response.headers.pop('Expires', None)
+    return response
+
+
+def accepts_gzip():
+    """Returns whether the client of the current request accepts gzip."""
+    return 'gzip' in request.accept_encodings
+
+
+def compress_response(response):
+    """Gzip compresses HTML and JSON responses above COMPRESS_MIN_SIZE, and
+    streamed ones as they are sent."""
+    if response.status_code != 200 or response.direct_passthrough or \
+            'Content-Encoding' in response.headers or \
+            response.mimetype not in COMPRESS_MIMETYPES:
+        return response
 
-CLIENT_ID = json.loads(open('client_secrets.json', 'r').read())['web'][
-    'client_id']
+    response.vary.add('Accept-Encoding')
+    if not accepts_gzip():
+        return response
+
+    if response.is_streamed:
+        response.response = gzip_stream(response.response)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.data
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.data = gzip_bytes(data)
+
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def remove_session(exception=None):
+    """Closes the session of the app context and returns its connection to
+    the pool."""
+    session.remove()
+
+
+@contextmanager
+def primary_reads():
+    """Sends the reads made inside the block to the primary, even in a
+    request routed to a replica. The caches load through this, so a lagging
+    replica can not put stale rows in them right after an invalidation."""
+    replica = None
+    if has_request_context():
+        replica, g.replica = getattr(g, 'replica', None), None
 
-engine = create_engine(db_url)
-Base.metadata.bind = engine
+    try:
+        yield
+
+    finally:
+        if replica is not None:
+            g.replica = replica
+
+
+def load_categories():
+    """Returns all the categories as plain rows for the category cache."""
+    with primary_reads():
+        return [CachedCategory(*row) for row in session.query(
+            Category.id, Category.name, Category.user_id,
+            Category.item_count).order_by(Category.id)]
+
+
+def load_latest_items(limit):
+    """Returns the newest limit items as plain rows for the latest items
+    feed."""
+    with primary_reads():
+        return [CachedItem(*row) for row in session.query(
+            Item.id, Item.title, Item.image_url, Item.category_id,
+            Category.name).join(Category, Item.category_id == Category.id).
+            order_by(desc(Item.id)).limit(limit)]
+
+
+def cached_item(item, category):
+    """Returns the plain row of the item, in the category, for the latest
+    items feed."""
+    return CachedItem(item.id, item.title, item.image_url, category.id,
+                      category.name)
+
+
+def image_path(filename):
+    """Returns the path the uploaded image with the filename is stored at.
+    Raises a ValueError if the filename would lead out of the images
+    directory."""
+    directory = os.path.realpath(get_resources().images_path)
+    path = os.path.realpath(os.path.join(directory, filename))
+    if os.path.dirname(path) != directory:
+        raise ValueError('Invalid image name %r' % filename)
+    return path
+
+
+def save_image(file):
+    """Stores the uploaded file if it has a valid extension and queues its
+    variants to be made. Returns the stored file name or None."""
+    ext = file.filename.split('.')[-1]
+    if not valid_ext.__contains__(ext):
+        return None
+
+    filename = store_upload(file, get_resources().images_path, ext)
+    image_processor.process(filename)
+    return filename
+
+
+def release_images(filenames):
+    """Removes the stored images, and their variants, that no item refers to
+    anymore. Only call this after the change that let go of them has been
+    committed. The same image can be shared by several items since images
+    are stored by content."""
+    filenames = set(filename for filename in filenames if filename)
+    if not filenames:
+        return
+
+    in_use = set(image_url for (image_url,) in session.query(
+        Item.image_url).filter(Item.image_url.in_(filenames)).distinct())
+    engine = get_resources().engine
+    for filename in filenames - in_use:
+        try:
+            paths = [image_path(name)
+                     for name in image_processor.files(filename)]
+        except ValueError:
+            current_app.logger.warning('Not removing the image %r, it is '
+                                       'not in the images directory',
+                                       filename)
+            continue
+
+        image_processor.forget(filename)
+
+        """An upload of the same image can take it up again before the
+        cleaner gets to it, so it checks again. The original goes last, so
+        an upload that comes in meanwhile finds no variants to reuse."""
+        image_cleaner.remove(reversed(paths),
+                             in_use=partial(image_in_use, engine, filename))
+
+
+def image_in_use(engine, filename):
+    """Returns whether any item refers to the stored image."""
+    return engine.execute(select([Item.id]).where(
+        Item.image_url == filename).limit(1)).first() is not None
+
+
+def item_image_url(filename, variant):
+    """Returns the url of the variant ('thumb' or 'display') of an item's
+    image, or of the original until the variant is ready."""
+    return url_for('static', filename='images/' +
+                   image_processor.url_filename(filename, variant))
+
+
+def category_list(categories, counts=False):
+    """Returns the category list items that the home, category and search
+    pages show, with the item counts if counts is set. The list is rendered
+    once per version of the category cache rather than on every page."""
+    def render():
+        return Markup(current_app.jinja_env.get_template(
+            'category_list.html').render(categories=categories,
+                                         counts=counts))
+
+    return fragments.get(('category_list', counts, request.script_root),
+                         categories, render)
+
+
+def adjust_item_count(category_id, delta):
+    """Adds delta to the item count of the category within the current
+    transaction. The UPDATE is done in the database so concurrent writers
+    can not lose each other's changes."""
+    session.query(Category).filter_by(id=category_id).update(
+        {Category.item_count: Category.item_count + delta},
+        synchronize_session=False)
+
+
+def get_catalog_version():
+    """Returns the version of the catalog data that the session reads. It
+    comes from the database, so every worker sees it change with every
+    write, and from the same replica the view then reads from."""
+    return changes.get_version(session)
+
+
+def get_cached_version():
+    """Returns a digest of everything the home page is made of: the cached
+    categories and latest items, which of the item thumbnails it links are
+    ready yet, and the templates and static files of this deploy. It needs
+    no query and always matches the copies this worker serves, however old
+    they are."""
+    items = latest_items.get()
+    thumbnails = [image_processor.url_filename(item.image_url, 'thumb')
+                  for item in items if item.image_url]
+    return hashlib.sha1(repr((
+        category_cache.get(), items, thumbnails,
+        get_resources().get_deploy_version()))).hexdigest()
+
+
+def catalog_etag(version, url, accept, gzip=False, email=''):
+    """Returns the ETag of a response built from the catalog data at the
+    version, for the url and Accept header, gzipped or not and for the user
+    with the email, if any."""
+    return hashlib.sha1('%s|%s|%s|%s|%s' % (version, url, accept, gzip,
+                                            email)).hexdigest()
+
+
+def conditional(per_user=False, version=get_catalog_version):
+    """Decorator for GET views whose response only depends on the catalog
+    data, the url and, if per_user is set, the logged in user. The response
+    gets a strong ETag built from version(), the version of the catalog data
+    the view reads, and a request with a matching If-None-Match is answered
+    with a 304 without running the view at all."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return view(*args, **kwargs)
+
+            if '_flashes' in login_session:
+                """Pending flash messages get rendered into the page, so it
+                can not be served from the client's copy."""
+                return view(*args, **kwargs)
+
+            user = get_user() if per_user else None
+            etag = catalog_etag(version(), request.url,
+                                request.headers.get('Accept', ''),
+                                accepts_gzip(), user['email'] if user else '')
+
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = \
+                'private, no-cache' if per_user else 'no-cache'
+            if per_user:
+                response.headers['Vary'] = 'Cookie'
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def query_budget(limit):
+    """Decorator for views that should run a bounded number of SQL
+    statements no matter how many rows they list. In debug mode any extra
+    statements, such as a template lazily loading a relationship per row,
+    are logged, or raised as an error if QUERY_BUDGET_RAISE is set."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_app.debug:
+                return view(*args, **kwargs)
+
+            g.statements = []
+            try:
+                response = view(*args, **kwargs)
+            finally:
+                statements, g.statements = g.statements, None
+
+            if len(statements) > limit:
+                message = '%s ran %i SQL statements, expected at most %i ' \
+                          '(missing eager load?):\n%s' % (
+                              view.__name__, len(statements), limit,
+                              '\n'.join(statements))
+                if current_app.config['QUERY_BUDGET_RAISE']:
+                    raise RuntimeError(message)
+                current_app.logger.warning(message)
+
+            return response
 
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
+        return wrapper
 
-app = Flask(__name__, static_url_path='/static')
+    return decorator
 
 
 def authorized(id):
     """This will return if the current user has permission to modify the
     item with the id or not."""
-    if get_user() is not None:
-        return get_user_id(get_user()['email']) == id
-    else:
-        return False
+    user_id = get_current_user_id()
+    return user_id is not None and user_id == id
 
 
 def already_a_user(user_email):
@@ -56,8 +741,10 @@ def create_user():
     new_user = User(name=login_session['username'], email=login_session[
         'email'], picture=login_session['picture'])
     session.add(new_user)
+    session.flush()
+    user_id = new_user.id
     session.commit()
-    return session.query(User).filter_by(email=login_session['email']).one().id
+    return user_id
 
 
 def get_user_info(user_id):
@@ -70,11 +757,31 @@ def get_user_id(user_email):
     return session.query(User).filter_by(email=user_email).one().id
 
 
+def get_current_user_id():
+    """Returns the id of the logged in user or None if logged out. The id is
+    stored in the session at login and memoized for the rest of the request,
+    so it is looked up at most once even for sessions from before it was
+    stored."""
+    if 'email' not in login_session:
+        return None
+
+    user_id = getattr(g, 'user_id', None)
+    if user_id is None:
+        user_id = login_session.get('user_id')
+        if user_id is None:
+            user_id = get_user_id(login_session['email'])
+            login_session['user_id'] = user_id
+        g.user_id = user_id
+
+    return user_id
+
+
 def get_user():
     """Returns a user dictionary object from the session if logged in or
     None if logged out."""
     try:
         user = {
+            'id': login_session.get('user_id'),
             'name': login_session['username'],
             'email': login_session['email'],
             'picture': login_session['picture']
@@ -86,38 +793,112 @@ def get_user():
     return user
 
 
-@app.route('/')
+def encode_cursor(item_id):
+    """Returns the opaque cursor that points just past the given item id."""
+    return base64.urlsafe_b64encode(str(item_id)).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns the item id that the cursor points past. Raises a ValueError
+    if the cursor was not made by encode_cursor."""
+    try:
+        item_id = int(base64.urlsafe_b64decode(
+            str(cursor) + '=' * (-len(cursor) % 4)))
+    except (TypeError, UnicodeEncodeError):
+        raise ValueError('Invalid cursor %r' % cursor)
+
+    if item_id < 0:
+        raise ValueError('Invalid cursor %r' % cursor)
+    return item_id
+
+
+def get_page_args(args=None):
+    """Returns the (limit, after) pagination arguments of the current request,
+    or of the query args given, or None if the client did not ask for a page.
+    Raises a ValueError if the arguments are invalid."""
+    if args is None:
+        args = request.args
+    limit = args.get('limit')
+    cursor = args.get('next')
+    if limit is None and cursor is None:
+        return None
+
+    limit = MAX_PAGE_SIZE if limit is None else int(limit)
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ValueError('limit must be between 1 and %i' % MAX_PAGE_SIZE)
+
+    after = 0 if cursor is None else decode_cursor(cursor)
+    return limit, after
+
+
+def get_items_page(query, limit, after):
+    """Returns a page of at most limit items from the query that come after
+    the item id after, together with the cursor for the next page or None on
+    the last page. The page is located through the Item.id primary key, so
+    each page costs the same no matter how deep into the listing it is."""
+    items = query.filter(Item.id > after).order_by(Item.id).limit(
+        limit + 1).all()
+
+    if len(items) > limit:
+        items = items[:limit]
+        return items, encode_cursor(items[-1].id)
+
+    return items, None
+
+
+@route('/')
+@read_only
+@conditional(per_user=True, version=get_cached_version)
+@query_budget(2)
 def index():
     """Main page of the web app. We need to query all the categories and all
     the items and render it on using the layout. There will also be links to
     add more items as well as categories in here."""
-    categories = session.query(Category).all()
+    categories = category_cache.get()
 
-    """Let's limit the items to be the latest 20 items."""
-    items = session.query(Item).order_by(desc(Item.id)).limit(20)
+    """The latest items come from the in memory feed."""
+    items = latest_items.get()
 
     return render_template('home.html', categories=categories, items=items,
                            user=get_user())
 
 
-@app.route('/category/<int:category_id>/items/')
+@route('/category/<int:category_id>/items/')
+@read_only
+@query_budget(3)
 def show_category(category_id):
     """This will list all the categories as well as all the items that are
     in the selected category. There will also be a link to delete the current
-    category in here."""
+    category in here. The items can be paged through with the limit and next
+    query parameters."""
+    try:
+        page = get_page_args()
+
+    except ValueError:
+        flash(u'Invalid page. Showing all the items instead.', 'warning')
+        return redirect(url_for('show_category', category_id=category_id))
+
     try:
         """First lets query all the categories, the selected category
-        reference by category_id, all the items in the category and the
-        items count for the category"""
-        categories = session.query(Category).all()
-        items = session.query(Item).filter_by(category_id=category_id).all()
-        items_count = (session.query(func.count(Item.id))).filter_by(
-            category_id=category_id).scalar()
+        reference by category_id, all the items (or the requested page of
+        items) in the category and the items count for the category"""
+        categories = category_cache.get()
+        items = session.query(Item).options(
+            joinedload(Item.category)).filter_by(category_id=category_id)
+        next_cursor = None
+        if page is None:
+            items = items.all()
+        else:
+            items, next_cursor = get_items_page(items, *page)
         main_category = session.query(Category).filter_by(id=category_id).one()
+        items_count = main_category.item_count
 
         return render_template('category.html', categories=categories,
                                items=items, items_count=items_count,
-                               main_category=main_category, user=get_user())
+                               main_category=main_category,
+                               next_cursor=next_cursor,
+                               limit=page[0] if page else None,
+                               user=get_user())
 
     except:
         """Trying to acces an invalid category"""
@@ -125,7 +906,7 @@ def show_category(category_id):
         return redirect(url_for('index'))
 
 
-@app.route('/category/new/', methods=['POST', 'GET'])
+@route('/category/new/', methods=['POST', 'GET'])
 def new_category():
     """ Creates a new category if it is a POST request and provides the form
     for a new category if it is a GET request"""
@@ -160,10 +941,14 @@ def new_category():
 
             name = request.form['name']
             name = name.strip()
-            user_id = get_user_id(login_session['email'])
+            user_id = get_current_user_id()
             category = Category(name=name, user_id=user_id)
             session.add(category)
+            session.flush()
+            changes.record_change(session, changes.CATEGORY, category.id,
+                                  changes.UPSERT)
             session.commit()
+            category_cache.invalidate()
             flash("New category %s added!" % name, 'success')
             return redirect(url_for('index'), code=301)
 
@@ -174,10 +959,11 @@ def new_category():
                                    user=get_user())
 
 
-@app.route('/category/<int:category_id>/delete', methods=['POST'])
+@route('/category/<int:category_id>/delete', methods=['POST'])
 def delete_category(category_id):
-    """Delete the selected category. But need to clear out the dependant
-    items first."""
+    """Delete the selected category along with all of its items in a single
+    transaction. The item images are removed in the background once the
+    deletion has been committed."""
 
     if get_user() is None:
         return redirect(url_for('login'))
@@ -188,27 +974,30 @@ def delete_category(category_id):
         deleting_category = session.query(Category).filter_by(
             id=category_id).one()
 
-        if delete_category.user_id != get_user_id(login_session['email']):
-            flash("This category belong to you!", 'danger')
+        if deleting_category.user_id != get_current_user_id():
+            flash("This category does not belong to you!", 'danger')
             flash("Logging you out!", 'warning')
             return redirect(url_for('gdisconnect'))
 
-        """Lets locate all the items that belong to the category."""
-        items_for_category = session.query(Item).filter_by(
-            category_id=category_id).all()
-
-        """Now we just need to delete each of the items."""
-        for item in items_for_category:
-            if item.image_url is not None:
-                os.remove(
-                    os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                                 'static/images/' + item.image_url))
-            session.delete(item)
-            session.commit()
-
-        """And then delete the category that contains them."""
+        """Remember the images of the items before they are gone."""
+        images = [image_url for (image_url,) in session.query(
+            Item.image_url).filter(Item.category_id == category_id,
+                                   Item.image_url != None).distinct()]
+
+        """Delete all the items with one statement, and then the category
+        that contains them, committing both together."""
+        changes.record_item_changes(session, Item.category_id == category_id,
+                                    changes.DELETE)
+        session.query(Item).filter_by(category_id=category_id).delete(
+            synchronize_session=False)
         session.delete(deleting_category)
+        changes.record_change(session, changes.CATEGORY, category_id,
+                              changes.DELETE)
         session.commit()
+        category_cache.invalidate()
+        latest_items.remove(lambda item: item.category_id == category_id)
+
+        release_images(images)
 
         """Redirect back to the main page."""
         flash("Category %s and all its items deleted!" %
@@ -217,13 +1006,11 @@ def delete_category(category_id):
 
     except Exception:
         session.rollback()
-        flash("Could not delete category %s!" % deleting_category.name,
-              'warning')
-        return redirect(url_for('show_category'), category_id=category_id,
-                        user=get_user())
+        flash("Could not delete category #%i!" % category_id, 'warning')
+        return redirect(url_for('show_category', category_id=category_id))
 
 
-@app.route('/item/new/', methods=['POST', 'GET'])
+@route('/item/new/', methods=['POST', 'GET'])
 def new_item():
     """Creates a new item if it is a POST request and loads the form to
     create one if it is a GET request."""
@@ -241,7 +1028,7 @@ def new_item():
                 return redirect(
                     "https://www.youtube.com/watch?v=dQw4w9WgXcQ", code=301)
 
-            user_id = get_user_id(login_session['email'])
+            user_id = get_current_user_id()
 
             item_title = request.form['title']
             item_description = request.form['description']
@@ -251,16 +1038,7 @@ def new_item():
             try:
                 """Try to access the uploaded file and see if it has a valid
                 extension."""
-                file = request.files['file']
-                ext = file.filename.split('.')[-1]
-                if valid_ext.__contains__(ext):
-                    filename = ''.join(random.choice(string.uppercase +
-                                                     string.digits) for x in
-                                       xrange(12))
-                    filename = filename + file.filename
-                    storage_path = os.path.dirname(os.path.realpath(__file__))
-                    storage_path = os.path.join(storage_path, 'static/images')
-                    file.save(os.path.join(storage_path, filename))
+                filename = save_image(request.files['file'])
 
             except:
                 pass
@@ -274,7 +1052,14 @@ def new_item():
                 new_item.image_url = filename
 
             session.add(new_item)
+            session.flush()
+            changes.record_change(session, changes.ITEM, new_item.id,
+                                  changes.UPSERT)
+            adjust_item_count(item_category_id, 1)
+            latest = cached_item(new_item, new_item.category)
             session.commit()
+            category_cache.invalidate()
+            latest_items.add(latest)
             flash("Create new item %s!" % new_item.title, 'success')
             return redirect(
                 url_for('index'))
@@ -283,7 +1068,7 @@ def new_item():
             session.rollback()
 
             flash(u'Inavlid parameters. Please try again.', 'warning')
-            categories = session.query(Category).all()
+            categories = category_cache.get()
             return render_template('new_item.html', item_title=item_title,
                                    item_description=item_description,
                                    item_category_id=item_category_id,
@@ -294,9 +1079,8 @@ def new_item():
         if get_user() is None:
             return redirect(url_for('login'))
 
-        categories = session.query(Category).all()
-        categories_count = (session.query(func.count(Category.id))).scalar()
-        if categories_count == 0:
+        categories = category_cache.get()
+        if len(categories) == 0:
             flash(u'There are no categories yet. Please create one first',
                   'warning')
             return redirect(url_for('new_category'))
@@ -308,10 +1092,13 @@ def new_item():
                                csrf_token=csrf_token, user=get_user())
 
 
-@app.route('/item/<int:item_id>/')
+@route('/item/<int:item_id>/')
+@read_only
+@query_budget(3)
 def show_item(item_id):
     """Shows the item referenced by item_id"""
-    item = session.query(Item).filter_by(id=item_id).one()
+    item = session.query(Item).options(joinedload(Item.category)).filter_by(
+        id=item_id).one()
     item_count = (session.query(func.count(Item.id))).scalar()
     if item_count == 0:
         flash("Item #%i not found. Please try again." % item_id, 'warning')
@@ -321,7 +1108,7 @@ def show_item(item_id):
                            authorized=authorized(item.user_id))
 
 
-@app.route('/item/<int:item_id>/delete', methods=['POST'])
+@route('/item/<int:item_id>/delete', methods=['POST'])
 def delete_item(item_id):
     """Will delete the item only if the user is the owner of the item."""
     if get_user() is None:
@@ -332,12 +1119,13 @@ def delete_item(item_id):
         if not authorized(item.user_id):
             flash('You are not authorized to delete this item!', 'warning')
             return redirect(url_for('show_item', item_id=item_id))
-        if item.image_url is not None:
-            os.remove(os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                               'static/images/'+item.image_url))
-            item.image_url = None
+        changes.record_change(session, changes.ITEM, item_id, changes.DELETE)
         session.delete(item)
+        adjust_item_count(item.category_id, -1)
         session.commit()
+        category_cache.invalidate()
+        latest_items.remove(lambda listed: listed.id == item_id)
+        release_images([item.image_url])
         flash("Deleted item %s!" % item.title, 'danger')
         return redirect(url_for('index'))
 
@@ -347,7 +1135,8 @@ def delete_item(item_id):
         return redirect(url_for('index'))
 
 
-@app.route('/item/<int:item_id>/edit/', methods=['POST', 'GET'])
+@route('/item/<int:item_id>/edit/', methods=['POST', 'GET'])
+@query_budget(6)
 def edit_item(item_id):
     """Creates a new item if it is a POST request and loads the form to
     create one if it is a GET request."""
@@ -368,31 +1157,22 @@ def edit_item(item_id):
             category = session.query(Category).filter_by(
                 id=item_category_id).one()
 
-            filename = item.image_url
+            if not authorized(item.user_id):
+                flash('You are not authorized to edit this item!', 'warning')
+                return redirect(url_for('show_item', item_id=item_id))
+
+            old_image = item.image_url
+            filename = old_image
 
             try:
                 """Similar to new item. This is access the file and if valid
                 file and valid ext found, will update the file. If no file
                 is found, will leave the image intact."""
-                file = request.files['file']
-                ext = file.filename.split('.')[-1]
-                if valid_ext.__contains__(ext):
-                    filename = ''.join(random.choice(string.uppercase +
-                                                     string.digits) for x in
-                                       xrange(12))
-                    filename = filename + file.filename
-                    storage_path = os.path.dirname(os.path.realpath(__file__))
-                    storage_path = os.path.join(storage_path, 'static/images')
-                    file.save(os.path.join(storage_path, filename))
-                    if item.image_url is not None:
-                        os.remove(os.path.join(
-                            os.path.dirname(os.path.realpath(__file__)),
-                            'static/images/' + item.image_url))
+                filename = save_image(request.files['file']) or filename
 
             except:
                 pass
 
-            item.image_url = filename
             delete_image = None
             try:
                 delete_image = request.form['delete_image']
@@ -401,24 +1181,31 @@ def edit_item(item_id):
                 pass
 
             if delete_image == 'on':
-                if item.image_url is not None:
-                    os.remove(os.path.join(
-                        os.path.dirname(os.path.realpath(__file__)),
-                        'static/images/' + item.image_url))
-                    item.image_url = None
-
-            print "2"
+                filename = None
 
-            if not authorized(item.user_id):
-                flash('You are not authorized to delete this item!', 'warning')
-                return redirect(url_for('show_item', item_id=item_id))
+            """Record the change first: that takes the feed lock, which
+            every writer has to take before it updates any row, or two
+            writers could each wait for what the other holds."""
+            changes.record_change(session, changes.ITEM, item_id,
+                                  changes.UPSERT)
+            item.image_url = filename
 
-            print "3"
+            if item.category_id != category.id:
+                """In category id order, so that two items moved in opposite
+                directions at once do not lock the rows the other needs."""
+                for category_id, delta in sorted(
+                        [(item.category_id, -1), (category.id, 1)]):
+                    adjust_item_count(category_id, delta)
 
             item.title = item_title
             item.description = item_description
             item.category = category
+            latest = cached_item(item, category)
             session.commit()
+            category_cache.invalidate()
+            latest_items.replace(latest)
+            if filename != old_image:
+                release_images([old_image])
             flash("Edited the item %s!" % item.title, 'success')
             return redirect(
                 url_for('index'))
@@ -433,10 +1220,11 @@ def edit_item(item_id):
         if get_user() is None:
             return redirect(url_for('login'))
 
-        item = session.query(Item).filter_by(id=item_id).one()
+        item = session.query(Item).options(
+            joinedload(Item.category)).filter_by(id=item_id).one()
         item_count = (session.query(func.count(Item.id)).filter_by(
             id=item_id)).scalar()
-        categories = session.query(Category).all()
+        categories = category_cache.get()
 
         if item_count == 0:
             flash("Could not find item $%i. Please try again," % item_id,
@@ -452,54 +1240,355 @@ def edit_item(item_id):
                                user=get_user())
 
 
-@app.route('/api/<int:category_id>/items/')
+@route('/api/<int:category_id>/items/')
+@read_only
+@conditional()
 def json_items(category_id):
     """Returns a json containing all the items that belong to the category
-    as referenced by the category_id."""
-    items = session.query(Item).filter_by(category_id=category_id).all()
+    as referenced by the category_id. If the limit or next query parameter
+    is given, only one page of items is returned along with the cursor for
+    the next page."""
+    try:
+        page = get_page_args()
+
+    except ValueError as e:
+        response = api_response(error=str(e))
+        response.status_code = 400
+        return response
 
-    return jsonify(items=[item.serialize() for item in items])
+    items = session.query(*item_columns()).filter(
+        Item.category_id == category_id)
 
+    if page is None:
+        return api_response(items=[item_dict(item) for item in items])
 
-@app.route('/api/<int:item_id>/item/')
+    items, next_cursor = get_items_page(items, *page)
+    return api_response(items=[item_dict(item) for item in items],
+                        next=next_cursor)
+
+
+@route('/api/<int:item_id>/item/')
+@read_only
+@conditional()
 def json_item(item_id):
     """Returns the single item referenced by the item_id."""
-    items = session.query(Item).filter_by(id=item_id).all()
+    items = session.query(*item_columns()).filter(Item.id == item_id)
+
+    return api_response(item=[item_dict(item) for item in items])
+
+
+def get_batch_ids():
+    """Returns the item ids asked for in the ids query parameter, as a comma
+    separated list, or in the ids list of a JSON POST body, in the order
+    they were asked for and without repeats. Raises a ValueError if they are
+    invalid or there are more than MAX_BATCH_IDS of them."""
+    if request.method == 'POST':
+        try:
+            ids = json.loads(request.data)['ids']
+        except (ValueError, KeyError, TypeError):
+            raise ValueError('expected a JSON object with an ids list')
+        if not isinstance(ids, list):
+            raise ValueError('ids must be a list')
+    else:
+        ids = [item_id for item_id in request.args.get('ids', '').split(',')
+               if item_id.strip()]
 
-    return jsonify(item=[item.serialize() for item in items])
+    unique_ids = []
+    for item_id in ids:
+        try:
+            if isinstance(item_id, (bool, float)):
+                raise TypeError()
+            item_id = int(item_id)
+        except (ValueError, TypeError):
+            raise ValueError('ids must be integers')
+
+        if item_id not in unique_ids:
+            unique_ids.append(item_id)
+            if len(unique_ids) > MAX_BATCH_IDS:
+                raise ValueError('at most %i ids can be fetched at once' %
+                                 MAX_BATCH_IDS)
+
+    if not unique_ids:
+        raise ValueError('ids is required')
+    return unique_ids
+
+
+@route('/api/items', methods=['GET', 'POST'])
+@read_only
+@conditional()
+def json_items_batch():
+    """Returns the items referenced by a list of ids, fetched with a single
+    query, in the order they were asked for. Ids that do not reference an
+    item are listed under missing."""
+    try:
+        ids = get_batch_ids()
+
+    except ValueError as e:
+        response = api_response(error=str(e))
+        response.status_code = 400
+        return response
+
+    items = dict((item.id, item) for item in
+                 session.query(*item_columns()).filter(Item.id.in_(ids)))
+
+    return api_response(items=[item_dict(items[item_id]) for item_id in ids
+                               if item_id in items],
+                        missing=[item_id for item_id in ids
+                                 if item_id not in items])
+
+
+def api_response(**data):
+    """Returns the data encoded in the format the client asked for: compact
+    JSON by default, indented JSON for browsers or MessagePack."""
+    mimetype, indent = negotiate(request.accept_mimetypes)
+    response = current_app.response_class(dumps(data, mimetype, indent),
+                                          mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
 
 
-@app.route('/api/all/')
+@route('/api/all/')
+@read_only
+@conditional()
 def json_all():
-    """Returns all the category and each item belonging to the categories."""
+    """Returns all the category and each item belonging to the categories.
+
+    The categories are fetched first and then their items, as plain rows in
+    category order, and the document is streamed out one category at a
+    time, so the whole catalog never has to be held in memory. The output
+    matches what api_response(result=[...]) would have produced."""
+    mimetype, indent = negotiate(request.accept_mimetypes)
+    categories = session.query(*category_columns()).order_by(
+        Category.id).all()
+
+    response = Response(stream_with_context(stream_list(
+        'result', len(categories), catalog_blocks(categories), mimetype,
+        indent)), mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
 
-    """Get all the categories"""
-    categories = session.query(Category).all()
 
-    """Create an empty list to store the categories in."""
-    result = []
+def catalog_blocks(categories):
+    """Generates the serialized categories, each together with the items
+    that belong to it. Only one category worth of items is held at a time.
+    Items of categories added since the categories were fetched are left
+    out, so the number of blocks always matches, and so are items without
+    a category, which belong to no block."""
+    rows = session.query(*item_columns()).filter(
+        Item.category_id != None).order_by(
+        Item.category_id, Item.id).yield_per(STREAM_BATCH_SIZE)
+    groups = groupby(rows, key=lambda row: row.category_id)
+    category_id, items = next(groups, (_NO_MORE_ITEMS, None))
+
     for category in categories:
-        """Get all the items in each category at a time."""
-        items = session.query(Item).filter_by(category_id=category.id).all()
+        while category_id is not _NO_MORE_ITEMS and \
+                category_id < category.id:
+            category_id, items = next(groups, (_NO_MORE_ITEMS, None))
+
+        yield {
+            'category': category_dict(category),
+            'items': [item_dict(item) for item in items]
+            if category_id == category.id else []
+        }
+
+
+def json_login_required():
+    """Returns the 401 response for API requests made without logging in, or
+    None if the user is logged in."""
+    if get_user() is not None:
+        return None
+
+    response = api_response(error='Login required')
+    response.status_code = 401
+    return response
 
-        """Empty list to store the items."""
-        category_items = []
-        for item in items:
-            """Serialize each item and add it to each categories list."""
-            category_items.append(item.serialize())
 
-        """Append a dictionary per category that has the serialized category
-        as well as the list of serialized items that belongs to it."""
-        result.append({
-            'category': category.serialize(),
-            'items': category_items
-        })
+@route('/api/import', methods=['POST'])
+def json_import():
+    """Imports the items in the NDJSON request body, one item per line, as
+    owned by the logged in user. The body is read as a stream and inserted
+    in batches that are committed one at a time. Returns how many items were
+    imported along with the line number and error of every line that was
+    not."""
+    response = json_login_required()
+    if response is not None:
+        return response
+
+    """Cross-site forms can post text/plain with the user's cookie, but
+    they can neither set a JSON content type nor read the CSRF token."""
+    csrf_token = request.headers.get('X-CSRF-Token')
+    if csrf_token is None or csrf_token != login_session.get('csrf_token'):
+        response = api_response(error='Missing or invalid X-CSRF-Token, '
+                                      'get one from /api/csrf-token')
+        response.status_code = 403
+        return response
+
+    if request.mimetype not in IMPORT_MIMETYPES:
+        response = api_response(error='Send the items as %s' %
+                                      ' or '.join(IMPORT_MIMETYPES))
+        response.status_code = 415
+        return response
+
+    report = import_items(session, iter(request.stream.readline, ''),
+                          get_current_user_id())
+    if report.imported:
+        category_cache.invalidate()
+        latest_items.invalidate()
+
+    return api_response(**report.serialize())
+
+
+@route('/api/csrf-token')
+def json_csrf_token():
+    """Returns the CSRF token of the logged in user's session, which
+    /api/import requests have to send in the X-CSRF-Token header."""
+    response = json_login_required()
+    if response is not None:
+        return response
+
+    if 'csrf_token' not in login_session:
+        login_session['csrf_token'] = ''.join(
+            random.choice(string.ascii_uppercase + string.digits)
+            for x in xrange(32))
 
-    """Return the JSON."""
-    return jsonify(result=result)
+    response = api_response(csrf_token=login_session['csrf_token'])
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 
-@app.route('/login/')
+@route('/api/export')
+@read_only
+def json_export():
+    """Streams every item, or only those of the category_id query parameter,
+    as NDJSON."""
+    response = json_login_required()
+    if response is not None:
+        return response
+
+    category_id = request.args.get('category_id', type=int)
+    return Response(stream_with_context(export_items(session, category_id)),
+                    mimetype='application/x-ndjson')
+
+
+@route('/api/changes')
+@read_only
+def json_changes():
+    """Returns the changes made to items and categories after the seq given
+    as the since query parameter, oldest first, a page at a time. Upserts
+    carry the current data of the item or category. Mirrors should keep the
+    next seq and ask again from there while more is true. A 410 means the
+    changes they need have been pruned: they have to take the latest seq,
+    which is returned as next when since is left out, resync from /api/all/
+    and carry on from that seq."""
+    if 'since' not in request.args:
+        return api_response(changes=[],
+                            next=changes.get_last_seq(session), more=False)
+
+    try:
+        since = int(request.args['since'])
+        limit = int(request.args.get('limit', CHANGES_PAGE_SIZE))
+        if since < 0 or limit < 1 or limit > CHANGES_PAGE_SIZE:
+            raise ValueError()
+
+    except ValueError:
+        response = api_response(error='since must be a seq and limit '
+                                      'between 1 and %i' % CHANGES_PAGE_SIZE)
+        response.status_code = 400
+        return response
+
+    page = changes.get_changes(session, since, limit)
+    if page is None:
+        response = api_response(error='Changes since %i are no longer '
+                                      'kept, a full resync is needed' % since)
+        response.status_code = 410
+        return response
+
+    page, more = page
+    data = changes.get_current_data(session, page)
+    result = []
+    for change in page:
+        serialized = change.serialize()
+        if change.op == changes.UPSERT:
+            serialized['data'] = data.get((change.kind, change.object_id))
+        result.append(serialized)
+
+    return api_response(changes=result,
+                        next=page[-1].seq if page else since, more=more)
+
+
+def get_search_args():
+    """Returns the (query, page, limit) search arguments of the current
+    request. Raises a ValueError if they are invalid."""
+    query = request.args.get('q', '').strip()
+    page = int(request.args.get('page', 1))
+    limit = int(request.args.get('limit', SEARCH_PAGE_SIZE))
+    if page < 1 or limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ValueError('page must be at least 1 and limit between 1 and %i'
+                         % MAX_PAGE_SIZE)
+    return query, page, limit
+
+
+@route('/search')
+@read_only
+def search():
+    """Lists the items matching the q query parameter, best match first."""
+    try:
+        query, page, limit = get_search_args()
+
+    except ValueError:
+        flash(u'Invalid search. Please try again.', 'warning')
+        return redirect(url_for('index'))
+
+    items, has_next = [], False
+    if query:
+        try:
+            items, has_next = search_items(session, query, page, limit,
+                                           current_app.config[
+                                               'SEARCH_BUDGET_MS'])
+
+        except SearchTimeout:
+            session.rollback()
+            flash(u'The search took too long. Please try a more specific '
+                  u'search.', 'warning')
+
+    return render_template('search.html', categories=category_cache.get(),
+                           items=items, query=query, page=page, limit=limit,
+                           has_next=has_next, user=get_user())
+
+
+@route('/api/search')
+@read_only
+@conditional()
+def json_search():
+    """Returns a page of the items matching the q query parameter, best
+    match first, along with the number of the next page if there is one."""
+    try:
+        query, page, limit = get_search_args()
+        if not query:
+            raise ValueError('q is required')
+
+    except ValueError as e:
+        response = api_response(error=str(e))
+        response.status_code = 400
+        return response
+
+    try:
+        items, has_next = search_items(session, query, page, limit,
+                                       current_app.config[
+                                           'SEARCH_BUDGET_MS'],
+                                       columns=item_columns())
+
+    except SearchTimeout:
+        session.rollback()
+        response = api_response(error='Search timed out')
+        response.status_code = 503
+        return response
+
+    return api_response(items=[item_dict(item) for item in items],
+                        page=page, next_page=page + 1 if has_next else None)
+
+
+@route('/login/')
 def login():
     csrf_token = ''.join(random.choice(string.uppercase + string.digits) for
                          x in xrange(32))
@@ -508,7 +1597,7 @@ def login():
                            user=get_user())
 
 
-@app.route('/gconnect', methods=['POST'])
+@route('/gconnect', methods=['POST'])
 def gconnect():
     # if the csrf test fails, return 401
     if request.args.get('csrf_token') != login_session['csrf_token']:
@@ -516,10 +1605,17 @@ def gconnect():
         response.headers['Content-Type'] = 'application/json'
         return response
     code = request.data
+    google = get_resources().google
     try:
-        oauth_flow = flow_from_clientsecrets('client_secrets.json', scope='')
+        oauth_flow = flow_from_clientsecrets(
+            current_app.config['CLIENT_SECRETS'], scope='')
         oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
+        credentials = google.exchange(oauth_flow, code)
+
+        # by this time, we can access the access_token sent in by google.
+        # the token and the user's profile are looked up at the same time.
+        access_token = credentials.access_token
+        result, data = google.check_token(access_token)
 
     # if the flowexchange has an error there is an issue with the
     # authorization code
@@ -529,12 +1625,12 @@ def gconnect():
         response.headers['Content-Type'] = 'application/json'
         return response
 
-    # by this time, we can access the access_token sent in by google.
-    access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s'
-           % access_token)
-    http = httplib2.Http()
-    result = json.loads(http.request(url, 'GET')[1])
+    # google did not answer in time, or not with JSON
+    except (requests.RequestException, ValueError):
+        response = make_response(json.dumps('Could not reach Google, please '
+                                            'try again.'), 504)
+        response.headers['Content-Type'] = 'application/json'
+        return response
 
     # there was an error with the http request with the acces token
     if result.get('error') is not None:
@@ -552,7 +1648,7 @@ def gconnect():
     # client id is not the same as the response from google. Issues to
     # someone else
 
-    if result['issued_to'] != CLIENT_ID:
+    if result['issued_to'] != get_client_id():
         response = make_response(json.dumps(
             'Token\'s client id does not match app\'s.', 401))
         response.headers['Content-Type'] = 'application/json'
@@ -564,25 +1660,22 @@ def gconnect():
         response = make_response(json.dumps('User is already connected.', 200))
         response.headers['Content-Type'] = 'applcation/json'
 
+    # a new session id, so one that was planted before the login does not
+    # get logged in along with the user
+    login_session.regenerate()
     login_session['credentials'] = credentials
     login_session['gplus_id'] = gplus_id
 
-    # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
-
-    data = answer.json()
-
     login_session['username'] = data['name']
     login_session['picture'] = data['picture']
     login_session['email'] = data['email']
 
     try:
-        create_user()
+        login_session['user_id'] = create_user()
         flash("Welcome to Catalog, %s!" % login_session['username'], 'success')
     except IntegrityError:
         session.rollback()
+        login_session['user_id'] = get_user_id(login_session['email'])
         flash("You have logged in as %s!" % login_session['username'],
               'success')
     response = jsonify({
@@ -594,7 +1687,7 @@ def gconnect():
     return response
 
 
-@app.route('/logout/')
+@route('/logout/')
 def gdisconnect():
 
     # if there are not users logged in
@@ -604,30 +1697,73 @@ def gdisconnect():
 
     credentials = login_session['credentials']
     access_token = credentials.access_token
-    url = "https://accounts.google.com/o/oauth2/revoke?token=%s" % access_token
-    http = httplib2.Http()
-    result = http.request(url, 'GET')[0]
-    print result
+    try:
+        status = get_resources().google.revoke(access_token)
+
+    except requests.RequestException:
+        flash("Could not reach Google, please try again.", 'warning')
+        return redirect(url_for('index'))
 
     # logout has happened succesfully or timeout has happened with the login
-    if result['status'] == '200' or result['status'] == '400':
+    if status == 200 or status == 400:
         del login_session['credentials']
         del login_session['gplus_id']
         del login_session['username']
         del login_session['email']
         del login_session['picture']
+        login_session.pop('user_id', None)
+        login_session.regenerate()
 
         flash("You have been successfully disconnected!", 'success')
         return redirect(url_for('index'))
 
     else:
-        response = make_response(json.dumps('error', result['status']))
+        response = make_response(json.dumps('error', status))
         response.headers['Content-Type'] = 'application/json'
         return response
 
 
+def create_app(config=None):
+    """Returns a new catalog app, configured from DEFAULT_CONFIG, the
+    environment and then the config dict. Creating it does not connect to
+    the database or read any file; that happens on first use. The schema is
+    created separately, with python ./manage.py create-schema."""
+    app = Flask(__name__, static_url_path='/static')
+    app.config.update(DEFAULT_CONFIG)
+    app.config.update(config_from_env())
+    app.config.update(config or {})
+    if not app.secret_key:
+        app.secret_key = os.urandom(24)
+
+    for rule, view, options in url_rules:
+        app.add_url_rule(rule, view_func=view, **options)
+    app.view_functions['static'] = serve_static
+    app.url_defaults(fingerprint_static_url)
+    app.before_request(route_reads)
+    app.after_request(remember_writes)
+    app.after_request(compress_response)
+    app.teardown_appcontext(remove_session)
+
+    """Templates are only checked for changes in debug mode."""
+    app.jinja_options = dict(app.jinja_options, auto_reload=app.debug)
+    if app.config['TEMPLATE_CACHE_DIR']:
+        app.jinja_options['bytecode_cache'] = templating.SharedBytecodeCache(
+            app.config['TEMPLATE_CACHE_DIR'])
+    app.jinja_env.globals['item_image_url'] = item_image_url
+    app.jinja_env.globals['category_list'] = category_list
+    app.session_interface = sessions.ServerSessionInterface(
+        sessions.make_store(app.config['SESSION_STORE']))
+
+    resources = app.extensions['catalog'] = Resources(app)
+
+    """Per-route latency, SQL statement count and SQL time, served at
+    /metrics. Requests slower than SLOW_REQUEST_MS are logged with their
+    SQL."""
+    resources.metrics = metrics.instrument(
+        app, slow_request_ms=app.config['SLOW_REQUEST_MS'])
+    return app
+
+
 if __name__ == '__main__':
-    app.debug = True
-    app.secret_key = "asdbkj132kj3bd24!#!#!1kfnF@$24FL"
-    app.config['SESSION_TYPE'] = 'filesystem'
-    app.run(host='', port=8080)
+    app = create_app()
+    app.run(host=app.config['HOST'], port=app.config['PORT'], threaded=True)
@@ -0,0 +1,108 @@
+"""The change feed: every write to an item or a category appends a Change,
+so mirrors can sync the changes since the last one they saw instead of
+pulling the whole catalog."""
+import datetime
+from sqlalchemy import select, literal, func
+from database_setup import Change, Item, Category
+from serialization import item_columns, category_columns, item_dict, \
+    category_dict
+
+
+ITEM = 'item'
+CATEGORY = 'category'
+UPSERT = 'upsert'
+DELETE = 'delete'
+
+"""Key of the PostgreSQL advisory lock that writers of changes hold until
+they commit."""
+FEED_LOCK_KEY = 0x636174616c6f67
+
+
+def lock_feed(session):
+    """Makes the transaction the only one writing changes until it commits
+    or rolls back. seq is handed out when a change is written, not when it
+    is committed, so without this a transaction that took a lower seq could
+    commit after a later one has been read and be skipped by the mirrors.
+    SQLite already lets one writer at a time in; elsewhere the latest change
+    is locked, which also keeps other writers from inserting after it.
+    Take it before updating any row, so all writers lock in the same
+    order."""
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        session.execute(select([func.pg_advisory_xact_lock(FEED_LOCK_KEY)]))
+    elif dialect != 'sqlite':
+        session.query(Change.seq).order_by(Change.seq.desc()).limit(1) \
+            .with_lockmode('update').all()
+
+
+def record_change(session, kind, object_id, op):
+    """Adds a change to the current transaction."""
+    lock_feed(session)
+    session.add(Change(kind=kind, object_id=object_id, op=op))
+
+
+def record_item_changes(session, criterion, op):
+    """Adds a change for every item matching the criterion to the current
+    transaction, with a single INSERT ... SELECT."""
+    lock_feed(session)
+    session.execute(Change.__table__.insert().from_select(
+        ['kind', 'object_id', 'op', 'created'],
+        select([literal(ITEM), Item.id, literal(op),
+                literal(datetime.datetime.utcnow())]).where(criterion)))
+
+
+def get_changes(session, since, limit):
+    """Returns up to limit changes after the seq since, oldest first, and
+    whether there are more. Returns None if changes after since have
+    already been pruned, in which case the client has to resync."""
+    oldest = session.query(func.min(Change.seq)).scalar()
+    if oldest is not None and since < oldest - 1:
+        return None
+
+    changes = session.query(Change).filter(Change.seq > since).order_by(
+        Change.seq).limit(limit + 1).all()
+    return changes[:limit], len(changes) > limit
+
+
+def get_current_data(session, changes):
+    """Returns the current serialized items and categories touched by the
+    changes, keyed by (kind, id), with one column query per kind."""
+    data = {}
+    for kind, model, columns, serialize in [
+            (ITEM, Item, item_columns(), item_dict),
+            (CATEGORY, Category, category_columns(), category_dict)]:
+        ids = set(change.object_id for change in changes
+                  if change.kind == kind and change.op == UPSERT)
+        if ids:
+            for row in session.query(*columns).filter(model.id.in_(ids)):
+                data[(kind, row.id)] = serialize(row)
+    return data
+
+
+def get_last_seq(session):
+    """Returns the seq of the latest change, or 0 if there are none."""
+    return session.query(func.max(Change.seq)).scalar() or 0
+
+
+def get_version(session):
+    """Returns the version of the catalog data the session reads, which
+    changes whenever a write is committed. On PostgreSQL that is the
+    transaction snapshot: the latest seq does not move when a transaction
+    that took a lower seq commits last. SQLite commits one writer at a time
+    in seq order, so there it is the latest seq."""
+    if session.get_bind().dialect.name == 'postgresql':
+        return session.execute(
+            'SELECT txid_current_snapshot()::text').scalar()
+    return get_last_seq(session)
+
+
+def prune_changes(session, retention):
+    """Deletes the changes older than the retention timedelta, always
+    keeping the latest one so seq never goes back. Returns how many were
+    deleted."""
+    last_seq = get_last_seq(session)
+    deleted = session.query(Change).filter(
+        Change.created < datetime.datetime.utcnow() - retention,
+        Change.seq < last_seq).delete(synchronize_session=False)
+    session.commit()
+    return deleted
@@ -0,0 +1,128 @@
+import errno
+import logging
+import os
+import threading
+import time
+import uuid
+from Queue import Queue
+
+
+logger = logging.getLogger(__name__)
+
+
+class FileCleaner(object):
+    """Removes files on a background thread so that request handlers do not
+    have to wait on the filesystem. Removals that fail are retried with a
+    growing delay and reported once they run out of attempts.
+
+    Files that may be taken up again between being queued and removed are
+    checked once more right before removal, see remove()."""
+
+    def __init__(self, attempts=5, delay=1.0, grace=600):
+        self.attempts = attempts
+        self.delay = delay
+        self.grace = grace
+        self.queue = Queue()
+        self.failed = []
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def remove(self, paths, in_use=None):
+        """Queues the files for removal. Only call this after the change that
+        stopped referencing them has been committed.
+
+        With in_use, the files are removed as a group, and only if they are
+        still unused when their turn comes. They are moved aside in order
+        first, so nothing can start using them during the check, then kept
+        if in_use() returns True or if any of them was written in the last
+        grace seconds. Whoever takes up one of the files again has to write
+        it anew, which marks it as recent. Files kept only for being recent
+        are checked again once the grace time has passed."""
+        if in_use is None:
+            for path in paths:
+                self.queue.put((path, 1))
+        else:
+            self.queue.put((list(paths), in_use))
+        self.start()
+
+    def start(self):
+        """Starts the worker thread the first time there is work for it, so
+        that a process forked after import gets its own worker."""
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run,
+                                               name='file-cleaner')
+                self.worker.daemon = True
+                self.worker.start()
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if isinstance(task[0], list):
+                    self.remove_unused(*task)
+                else:
+                    self.remove_file(*task)
+            except Exception:
+                logger.exception('Could not remove %s', task[0])
+            finally:
+                self.queue.task_done()
+
+    def remove_unused(self, paths, in_use):
+        moved = []
+        suffix = '.%s.removing' % uuid.uuid4().hex
+        try:
+            for path in paths:
+                try:
+                    os.rename(path, path + suffix)
+                    moved.append(path)
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+            recent = any(time.time() - os.path.getmtime(path + suffix) <
+                         self.grace for path in moved)
+            if moved and not recent and not in_use():
+                for path in moved:
+                    self.remove_file(path + suffix, 1)
+                return
+
+        except Exception:
+            """Keep the files rather than risk losing one in use."""
+            logger.exception('Could not check whether %s is unused',
+                             paths[-1])
+            recent = True
+
+        for path in reversed(moved):
+            os.rename(path + suffix, path)
+        if recent:
+            retry = threading.Timer(self.grace, self.queue.put,
+                                    [(paths, in_use)])
+            retry.daemon = True
+            retry.start()
+
+    def remove_file(self, path, attempt):
+        try:
+            os.remove(path)
+
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                """Already gone, which is what we wanted."""
+                return
+
+            if attempt >= self.attempts:
+                logger.error('Giving up removing %s after %i attempts: %s',
+                             path, attempt, e)
+                self.failed.append((path, str(e)))
+                return
+
+            logger.warning('Could not remove %s (attempt %i): %s', path,
+                           attempt, e)
+            retry = threading.Timer(self.delay * 2 ** (attempt - 1),
+                                    self.queue.put, [(path, attempt + 1)])
+            retry.daemon = True
+            retry.start()
+
+    def join(self):
+        """Blocks until every queued removal has been attempted once."""
+        self.queue.join()
@@ -1,5 +1,7 @@
-from sqlalchemy import Column, ForeignKey, Integer, String
-from sqlalchemy import create_engine
+import datetime
+import os
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime
+from sqlalchemy import create_engine, event, DDL
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -34,6 +36,11 @@ class Category(Base):
         Integer, ForeignKey('user.id')
     )
     user = relationship(User)
+    """Number of items in the category. Kept up to date by the item handlers
+    in catalog.py and rebuilt by `python manage.py check-counts --fix`."""
+    item_count = Column(
+        Integer, nullable=False, default=0, server_default='0'
+    )
 
     def serialize(self):
         """Serializes the model for json dumps."""
@@ -58,11 +65,11 @@ class Item(Base):
         String, nullable=True
     )
     category_id = Column(
-        Integer, ForeignKey('category.id')
+        Integer, ForeignKey('category.id'), index=True
     )
     category = relationship(Category)
     user_id = Column(
-        Integer, ForeignKey('user.id')
+        Integer, ForeignKey('user.id'), index=True
     )
     user = relationship(User)
 
@@ -76,9 +83,73 @@ class Item(Base):
         }
 
 
+class Change(Base):
+    """One entry of the change feed: an item or a category was created or
+    updated ('upsert') or deleted ('delete'). seq only ever grows, so mirrors
+    can ask for everything after the last seq they have seen."""
+    __tablename__ = 'change'
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = Column(
+        Integer, primary_key=True
+    )
+    kind = Column(
+        String(16), nullable=False
+    )
+    object_id = Column(
+        Integer, nullable=False
+    )
+    op = Column(
+        String(8), nullable=False
+    )
+    created = Column(
+        DateTime, nullable=False, default=datetime.datetime.utcnow, index=True
+    )
+
+    def serialize(self):
+        """Serializes the model for json dumps."""
+        return {
+            "seq": self.seq,
+            "kind": self.kind,
+            "id": self.object_id,
+            "op": self.op
+        }
+
+
+"""Full-text search index over the item title and description. PostgreSQL
+uses a GIN index on the same expression search.py queries with, SQLite an
+FTS5 table kept in sync by triggers. sql/upgrade.sql adds the PostgreSQL
+index to existing databases."""
+event.listen(Item.__table__, 'after_create', DDL(
+    "CREATE INDEX item_search_idx ON item USING gin "
+    "(to_tsvector('english', title || ' ' || description))"
+).execute_if(dialect='postgresql'))
+
+for statement in [
+    "CREATE VIRTUAL TABLE item_fts USING fts5(title, description, "
+    "content='item', content_rowid='id')",
+    "CREATE TRIGGER item_fts_insert AFTER INSERT ON item BEGIN "
+    "INSERT INTO item_fts(rowid, title, description) "
+    "VALUES (new.id, new.title, new.description); END",
+    "CREATE TRIGGER item_fts_delete AFTER DELETE ON item BEGIN "
+    "INSERT INTO item_fts(item_fts, rowid, title, description) "
+    "VALUES ('delete', old.id, old.title, old.description); END",
+    "CREATE TRIGGER item_fts_update AFTER UPDATE ON item BEGIN "
+    "INSERT INTO item_fts(item_fts, rowid, title, description) "
+    "VALUES ('delete', old.id, old.title, old.description); "
+    "INSERT INTO item_fts(rowid, title, description) "
+    "VALUES (new.id, new.title, new.description); END"
+]:
+    event.listen(Item.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='sqlite'))
+
 
+def create_schema(engine):
+    """Creates the tables, with their indexes and triggers, that do not exist
+    yet. Existing tables are left as they are; sql/upgrade.sql upgrades
+    them."""
+    Base.metadata.create_all(engine)
 
-db_url = "postgresql:///catalog"
 
-engine = create_engine(db_url)
-Base.metadata.create_all(engine)
+if __name__ == '__main__':
+    create_schema(create_engine(
+        os.environ.get('CATALOG_DATABASE_URL', "postgresql:///catalog")))
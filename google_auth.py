@@ -0,0 +1,127 @@
+"""Calls to Google's OAuth endpoints made while logging in and out. They
+all go through one pooled HTTP session with a timeout, so connections to
+Google are reused and a slow Google can only hold a worker for so long."""
+import hashlib
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+
+
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo'
+USERINFO_URL = 'https://www.googleapis.com/oauth2/v1/userinfo'
+REVOKE_URL = 'https://accounts.google.com/o/oauth2/revoke'
+
+"""Most tokeninfo results kept in the cache at once."""
+TOKENINFO_CACHE_SIZE = 1000
+
+
+class Http(object):
+    """Stands in for the httplib2.Http that oauth2client makes its requests
+    with, sending them through the pooled session instead."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, uri, method='GET', body=None, headers=None,
+                redirections=None, connection_type=None):
+        response = self.client.session.request(
+            method, uri, data=body, headers=headers,
+            timeout=self.client.timeout)
+        info = dict(response.headers)
+        info['status'] = str(response.status_code)
+        return httplib2.Response(info), response.content
+
+
+class GoogleClient(object):
+    """Talks to Google's OAuth endpoints over a pool of keep-alive
+    connections. Every call gives up after timeout seconds with a
+    requests.RequestException. Successful tokeninfo results are cached for
+    tokeninfo_ttl seconds."""
+
+    def __init__(self, timeout=5.0, pool_size=10, tokeninfo_ttl=60,
+                 tokeninfo_url=TOKENINFO_URL, userinfo_url=USERINFO_URL,
+                 revoke_url=REVOKE_URL):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.tokeninfo_ttl = tokeninfo_ttl
+        self.tokeninfo_url = tokeninfo_url
+        self.userinfo_url = userinfo_url
+        self.revoke_url = revoke_url
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.http = Http(self)
+
+        self.lock = threading.Lock()
+        self.pool = None
+        self.tokeninfo_cache = {}
+
+    def exchange(self, flow, code):
+        """Exchanges the authorization code for credentials through the
+        oauth2client flow."""
+        return flow.step2_exchange(code, http=self.http)
+
+    def get_json(self, url, params):
+        response = self.session.get(url, params=params, timeout=self.timeout)
+        return response.json()
+
+    def tokeninfo(self, access_token):
+        """Returns what Google knows about the access token."""
+        key = hashlib.sha256(access_token).hexdigest()
+        cached = self.tokeninfo_cache.get(key)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+
+        result = self.get_json(self.tokeninfo_url,
+                               {'access_token': access_token})
+        if result.get('error') is None:
+            with self.lock:
+                if len(self.tokeninfo_cache) >= TOKENINFO_CACHE_SIZE:
+                    now = time.time()
+                    for stale in [cache_key for cache_key, (expires, _) in
+                                  self.tokeninfo_cache.items()
+                                  if expires <= now]:
+                        del self.tokeninfo_cache[stale]
+                if len(self.tokeninfo_cache) >= TOKENINFO_CACHE_SIZE:
+                    self.tokeninfo_cache.clear()
+                self.tokeninfo_cache[key] = (time.time() + self.tokeninfo_ttl,
+                                             result)
+        return result
+
+    def userinfo(self, access_token):
+        """Returns the profile of the user the access token belongs to."""
+        return self.get_json(self.userinfo_url,
+                             {'access_token': access_token, 'alt': 'json'})
+
+    def check_token(self, access_token):
+        """Returns the (tokeninfo, userinfo) of the access token, fetched at
+        the same time."""
+        with self.lock:
+            """The pool is only started when first needed, so a process
+            forked after import gets its own threads."""
+            if self.pool is None:
+                self.pool = ThreadPool(self.pool_size)
+
+        userinfo = self.pool.apply_async(self.userinfo, (access_token,))
+        tokeninfo = self.tokeninfo(access_token)
+        return tokeninfo, userinfo.get()
+
+    def revoke(self, access_token):
+        """Revokes the access token. Returns the HTTP status Google answered
+        with."""
+        self.forget(access_token)
+        return self.session.get(self.revoke_url,
+                                params={'token': access_token},
+                                timeout=self.timeout).status_code
+
+    def forget(self, access_token):
+        """Drops the cached tokeninfo of the access token."""
+        key = hashlib.sha256(access_token).hexdigest()
+        with self.lock:
+            self.tokeninfo_cache.pop(key, None)
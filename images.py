@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+logger = logging.getLogger(__name__)
+
+"""Extensions of the images that can be uploaded."""
+IMAGE_EXTENSIONS = ['png', 'jpg', 'jpeg', 'gif']
+
+"""Names store_upload gives the images it stores."""
+STORED_NAME = re.compile(r'^[0-9a-f]{64}\.(%s)$' % '|'.join(IMAGE_EXTENSIONS))
+
+"""Resized copies made of every uploaded image, by name and the box they are
+scaled down to fit in. Twice the size they are shown at in style.css, so
+they stay sharp on high density screens."""
+VARIANTS = {
+    'thumb': (64, 64),
+    'display': (200, 200)
+}
+
+"""Size of the chunks uploads are copied and hashed in."""
+CHUNK_SIZE = 64 * 1024
+
+
+def variant_name(filename, variant):
+    """Returns the file name of the variant of the stored image."""
+    name, ext = os.path.splitext(filename)
+    return '%s-%s%s' % (name, variant, ext)
+
+
+def is_stored_name(filename):
+    """Returns whether the filename is one store_upload could have given an
+    image, which rules out any path outside of its directory."""
+    return STORED_NAME.match(filename) is not None
+
+
+def store_upload(file, directory, ext):
+    """Copies the uploaded file into the directory under a name made from the
+    SHA-256 of its content and returns that name. The upload is streamed to a
+    temporary file while it is hashed, and identical images end up stored
+    only once."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    digest = hashlib.sha256()
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.upload')
+    try:
+        with os.fdopen(handle, 'wb') as temp:
+            for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                temp.write(chunk)
+
+        """An identical image may already be stored, but it is written
+        anew all the same: a FileCleaner about to remove it then sees it as
+        recent and keeps it."""
+        filename = '%s.%s' % (digest.hexdigest(), ext.lower())
+        os.rename(temp_path, os.path.join(directory, filename))
+
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    return filename
+
+
+class ImageProcessor(object):
+    """Makes the resized variants of stored images on a pool of worker
+    threads, off the request path. Until a variant is ready the original
+    image is served in its place."""
+
+    def __init__(self, directory, workers=2):
+        self.directory = directory
+        self.workers = workers
+        self.pool = None
+        self.ready = set()
+        self.lock = threading.Lock()
+
+    def process(self, filename):
+        """Queues the variants of the stored image to be made."""
+        if Image is None:
+            return
+
+        with self.lock:
+            """The pool is only started when first needed, so a process
+            forked after import gets its own threads."""
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+        self.pool.apply_async(self.make_variants, (filename,))
+
+    def make_variants(self, filename):
+        source = os.path.join(self.directory, filename)
+        for variant, size in VARIANTS.items():
+            target = os.path.join(self.directory,
+                                  variant_name(filename, variant))
+            if os.path.exists(target):
+                continue
+
+            try:
+                image = Image.open(source)
+                image.thumbnail(size, Image.ANTIALIAS)
+                """Write under a temporary name first so a half written
+                variant is never served."""
+                temp_path = '%s.%i.tmp' % (target,
+                                           threading.current_thread().ident)
+                image.save(temp_path, format=image.format or 'PNG')
+                os.rename(temp_path, target)
+
+            except Exception:
+                logger.exception('Could not make the %s variant of %s',
+                                 variant, filename)
+
+    def url_filename(self, filename, variant):
+        """Returns the name of the file to serve for the variant of the
+        image: the variant if it has been made, the original otherwise."""
+        name = variant_name(filename, variant)
+        if name in self.ready:
+            return name
+
+        if os.path.exists(os.path.join(self.directory, name)):
+            self.ready.add(name)
+            return name
+
+        return filename
+
+    def files(self, filename):
+        """Returns the names of the image and of all its variants."""
+        return [filename] + [variant_name(filename, variant)
+                             for variant in VARIANTS]
+
+    def forget(self, filename):
+        """Forgets the variants of an image that is being removed."""
+        for name in self.files(filename):
+            self.ready.discard(name)
@@ -0,0 +1,185 @@
+"""Maintenance commands for the catalog database.
+
+Usage: python manage.py <command> [options]
+"""
+import argparse
+import datetime
+import sys
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+import assets
+import templating
+from bulk import import_items, export_items
+from catalog import create_app, get_resources
+from changes import prune_changes
+from database_setup import Category, Item, User, create_schema
+
+
+def check_counts(session, fix=False):
+    """Compares the item_count of every category against its items and, if
+    fix is set, rebuilds the counts that are off. Returns the list of
+    (category_id, stored, actual) tuples that did not match."""
+    actual = dict(session.query(Item.category_id, func.count(Item.id)).
+                  group_by(Item.category_id))
+
+    mismatches = []
+    for category_id, stored in session.query(Category.id,
+                                             Category.item_count):
+        count = actual.get(category_id, 0)
+        if stored != count:
+            mismatches.append((category_id, stored, count))
+
+    if fix and mismatches:
+        """Rebuild in one statement so counts changed by requests running
+        meanwhile are taken into account."""
+        count = session.query(func.count(Item.id)).filter(
+            Item.category_id == Category.id).correlate(Category).as_scalar()
+        session.query(Category).update({Category.item_count: count},
+                                       synchronize_session=False)
+        session.commit()
+
+    return mismatches
+
+
+def make_session(app):
+    """Returns a new session on the app's database."""
+    return sessionmaker(bind=get_resources(app).engine)()
+
+
+def command_create_schema(app, args):
+    create_schema(get_resources(app).engine)
+    print 'Created the tables that did not exist yet.'
+    return 0
+
+
+def command_check_counts(app, args):
+    session = make_session(app)
+    mismatches = check_counts(session, fix=args.fix)
+    for category_id, stored, count in mismatches:
+        print 'Category #%i has item_count %i but %i items%s' % (
+            category_id, stored, count, ' (fixed)' if args.fix else '')
+
+    if not mismatches:
+        print 'All category item counts are consistent.'
+
+    return 1 if mismatches and not args.fix else 0
+
+
+def command_import_items(app, args):
+    session = make_session(app)
+    if session.query(User).filter_by(id=args.user_id).count() == 0:
+        print >> sys.stderr, 'There is no user #%i.' % args.user_id
+        return 1
+
+    report = import_items(session, args.file, args.user_id,
+                          batch_size=args.batch_size)
+
+    """Let the running app know the catalog changed."""
+    backend = get_resources(app).cache_backend
+    backend.bump_generation('categories')
+    backend.bump_generation('latest_items')
+
+    for error in report.errors:
+        print >> sys.stderr, 'Line %(line)i: %(error)s' % error
+    print 'Imported %i items, %i lines had errors.' % (report.imported,
+                                                       report.error_count)
+    return 1 if report.error_count else 0
+
+
+def command_export_items(app, args):
+    session = make_session(app)
+    for line in export_items(session, args.category_id):
+        args.file.write(line)
+    return 0
+
+
+def command_prune_changes(app, args):
+    session = make_session(app)
+    deleted = prune_changes(session, datetime.timedelta(days=args.days))
+    print 'Pruned %i changes older than %i days.' % (deleted, args.days)
+    return 0
+
+
+def command_prune_sessions(app, args):
+    deleted = app.session_interface.store.prune()
+    print 'Pruned %i expired sessions.' % deleted
+    return 0
+
+
+def command_build_assets(app, args):
+    count = assets.build(app.static_folder)
+    print 'Fingerprinted %i static files%s.' % (
+        count, '' if assets.brotli else ' (brotli not installed, gzip only)')
+    return 0
+
+
+def command_build_templates(app, args):
+    if not app.config['TEMPLATE_CACHE_DIR']:
+        print >> sys.stderr, 'The template cache is turned off.'
+        return 1
+
+    count = templating.precompile(app)
+    print 'Compiled %i templates into %s.' % (
+        count, app.config['TEMPLATE_CACHE_DIR'])
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Catalog maintenance.')
+    commands = parser.add_subparsers()
+
+    schema = commands.add_parser(
+        'create-schema', help='create the tables that do not exist yet')
+    schema.set_defaults(func=command_create_schema)
+
+    check = commands.add_parser(
+        'check-counts', help='check the per-category item counts')
+    check.add_argument('--fix', action='store_true',
+                       help='rebuild the counts that are off')
+    check.set_defaults(func=command_check_counts)
+
+    import_parser = commands.add_parser(
+        'import-items', help='import items from an NDJSON file')
+    import_parser.add_argument('file', type=argparse.FileType('r'),
+                               help='NDJSON file to read, - for stdin')
+    import_parser.add_argument('--user-id', type=int, required=True,
+                               help='id of the user owning the items')
+    import_parser.add_argument('--batch-size', type=int, default=1000,
+                               help='items inserted per commit')
+    import_parser.set_defaults(func=command_import_items)
+
+    export_parser = commands.add_parser(
+        'export-items', help='export the items as NDJSON')
+    export_parser.add_argument('file', type=argparse.FileType('w'),
+                               nargs='?', default=sys.stdout,
+                               help='file to write, stdout by default')
+    export_parser.add_argument('--category-id', type=int,
+                               help='only export the items of the category')
+    export_parser.set_defaults(func=command_export_items)
+
+    prune = commands.add_parser(
+        'prune-changes', help='delete old entries of the change feed')
+    prune.add_argument('--days', type=int, default=7,
+                       help='days of changes to keep, 7 by default')
+    prune.set_defaults(func=command_prune_changes)
+
+    prune_sessions = commands.add_parser(
+        'prune-sessions', help='delete the expired login sessions')
+    prune_sessions.set_defaults(func=command_prune_sessions)
+
+    build = commands.add_parser(
+        'build-assets',
+        help='fingerprint and precompress the static files for deployment')
+    build.set_defaults(func=command_build_assets)
+
+    templates = commands.add_parser(
+        'build-templates',
+        help='compile the templates into the shared bytecode cache')
+    templates.set_defaults(func=command_build_templates)
+
+    args = parser.parse_args(argv)
+    return args.func(create_app(), args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
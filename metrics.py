@@ -0,0 +1,168 @@
+"""Per-route request timing and SQL instrumentation, exposed in the
+Prometheus text format. The numbers are kept per process, so with several
+workers each one has to be scraped (or the app run with one process per
+scrape target)."""
+import logging
+import threading
+import time
+from flask import g, request, has_request_context
+from sqlalchemy import event
+
+
+logger = logging.getLogger(__name__)
+
+"""Upper bounds, in seconds, of the request latency histogram buckets."""
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RouteMetrics(object):
+    """The numbers kept for a single route."""
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+
+
+class Metrics(object):
+    """Collects the latency, SQL statement count and SQL time of every
+    request, by route."""
+
+    def __init__(self):
+        self.routes = {}
+        self.lock = threading.Lock()
+
+    def observe(self, route, seconds, sql_statements, sql_seconds):
+        with self.lock:
+            metrics = self.routes.get(route)
+            if metrics is None:
+                metrics = self.routes[route] = RouteMetrics()
+
+            metrics.count += 1
+            metrics.seconds += seconds
+            metrics.sql_statements += sql_statements
+            metrics.sql_seconds += sql_seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    metrics.buckets[i] += 1
+                    break
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format."""
+        with self.lock:
+            routes = sorted((route, metrics) for route, metrics in
+                            self.routes.items())
+            lines = [
+                '# HELP catalog_request_duration_seconds Request latency.',
+                '# TYPE catalog_request_duration_seconds histogram'
+            ]
+            for route, metrics in routes:
+                total = 0
+                for bound, count in zip(BUCKETS, metrics.buckets):
+                    total += count
+                    lines.append('catalog_request_duration_seconds_bucket'
+                                 '{route="%s",le="%s"} %i' % (route, bound,
+                                                             total))
+                lines.append('catalog_request_duration_seconds_bucket'
+                             '{route="%s",le="+Inf"} %i' % (route,
+                                                            metrics.count))
+                lines.append('catalog_request_duration_seconds_sum'
+                             '{route="%s"} %f' % (route, metrics.seconds))
+                lines.append('catalog_request_duration_seconds_count'
+                             '{route="%s"} %i' % (route, metrics.count))
+
+            lines += [
+                '# HELP catalog_sql_statements_total SQL statements run.',
+                '# TYPE catalog_sql_statements_total counter'
+            ]
+            for route, metrics in routes:
+                lines.append('catalog_sql_statements_total{route="%s"} %i' %
+                             (route, metrics.sql_statements))
+
+            lines += [
+                '# HELP catalog_sql_duration_seconds_total Time spent '
+                'running SQL statements.',
+                '# TYPE catalog_sql_duration_seconds_total counter'
+            ]
+            for route, metrics in routes:
+                lines.append('catalog_sql_duration_seconds_total'
+                             '{route="%s"} %f' % (route, metrics.sql_seconds))
+
+        return '\n'.join(lines) + '\n'
+
+
+def instrument_engine(engine):
+    """Hooks the engine's statements into the metrics of the request that
+    runs them. Call it for every engine of an app passed to instrument."""
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_statement(conn, cursor, statement, parameters, context,
+                        executemany):
+        conn.info['metrics_started'] = time.time()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def end_statement(conn, cursor, statement, parameters, context,
+                      executemany):
+        observe_statement(conn, statement)
+
+    @event.listens_for(engine, 'dbapi_error')
+    def fail_statement(conn, cursor, statement, parameters, context,
+                       exception):
+        observe_statement(conn, statement)
+
+
+def observe_statement(conn, statement):
+    """Counts the statement that just ran on the connection, or failed, in
+    the metrics of the current request."""
+    started = conn.info.pop('metrics_started', None)
+    if started is None or not has_request_context() or \
+            getattr(g, 'metrics_started', None) is None:
+        return
+
+    seconds = time.time() - started
+    g.metrics_sql_statements += 1
+    g.metrics_sql_seconds += seconds
+    if g.metrics_statements is not None:
+        g.metrics_statements.append((seconds, statement))
+
+
+def instrument(app, slow_request_ms=None):
+    """Hooks the metrics into the app's requests and returns them. Requests
+    slower than slow_request_ms are logged along with the statements they
+    ran. The time of streamed responses is counted until the last chunk has
+    been sent. SQL is only counted on engines passed to instrument_engine."""
+    metrics = Metrics()
+    slow_seconds = slow_request_ms / 1000.0 if slow_request_ms else None
+
+    @app.before_request
+    def start_request():
+        g.metrics_started = time.time()
+        g.metrics_sql_statements = 0
+        g.metrics_sql_seconds = 0.0
+        g.metrics_statements = [] if slow_seconds is not None else None
+
+    @app.teardown_request
+    def end_request(exception=None):
+        started = getattr(g, 'metrics_started', None)
+        if started is None:
+            return
+
+        seconds = time.time() - started
+        route = request.endpoint or 'unknown'
+        metrics.observe(route, seconds, g.metrics_sql_statements,
+                        g.metrics_sql_seconds)
+
+        if slow_seconds is not None and seconds >= slow_seconds:
+            logger.warning(
+                'Slow request %s %s (%s) took %.0f ms, %i SQL statements in '
+                '%.0f ms:\n%s', request.method, request.path, route,
+                seconds * 1000, g.metrics_sql_statements,
+                g.metrics_sql_seconds * 1000,
+                '\n'.join('%.1f ms: %s' % (statement_seconds * 1000, statement)
+                          for statement_seconds, statement in
+                          g.metrics_statements))
+        g.metrics_started = None
+
+    return metrics
@@ -0,0 +1,124 @@
+import re
+import time
+from sqlalchemy import text, and_, or_
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload
+from database_setup import Item
+
+
+class SearchTimeout(Exception):
+    """Raised when a search runs past its latency budget."""
+    pass
+
+
+"""Ranks the items whose title and description match the query. The
+to_tsvector expression has to stay the same as the one item_search_idx is
+built on, or PostgreSQL will not use the index."""
+POSTGRESQL_SEARCH = text(
+    "SELECT item.id FROM item, plainto_tsquery('english', :query) query "
+    "WHERE to_tsvector('english', item.title || ' ' || item.description) "
+    "@@ query ORDER BY ts_rank(to_tsvector('english', item.title || ' ' || "
+    "item.description), query) DESC, item.id LIMIT :limit OFFSET :offset")
+
+SQLITE_SEARCH = text(
+    "SELECT rowid FROM item_fts WHERE item_fts MATCH :query "
+    "ORDER BY rank, rowid LIMIT :limit OFFSET :offset")
+
+
+def query_words(query):
+    """Returns the words of the free text query."""
+    return re.findall(r'\w+', query, re.UNICODE)
+
+
+def sqlite_match_query(query):
+    """Turns free text into an FTS5 query that matches every word, so that
+    quotes and operators typed by the user can not break the syntax."""
+    return ' '.join('"%s"' % word for word in query_words(query))
+
+
+def like_search_ids(session, query, limit, offset):
+    """Returns the ids of the items whose title or description contains
+    every word of the query, oldest first. This is the search of databases
+    without full-text search: it scans the whole item table, ranks nothing
+    and can not be held to a latency budget."""
+    words = query_words(query)
+    if not words:
+        return []
+
+    criteria = []
+    for word in words:
+        pattern = '%' + word.replace('_', '\\_') + '%'
+        criteria.append(or_(Item.title.ilike(pattern, escape='\\'),
+                            Item.description.ilike(pattern, escape='\\')))
+    return [row[0] for row in session.query(Item.id).filter(
+        and_(*criteria)).order_by(Item.id).limit(limit).offset(offset)]
+
+
+def search_item_ids(session, query, limit, offset, budget_ms):
+    """Returns the ids of the best matching items, best match first. Raises
+    SearchTimeout if the database takes longer than budget_ms. Databases
+    other than PostgreSQL and SQLite fall back to like_search_ids."""
+    connection = session.connection()
+    dialect = connection.dialect.name
+    params = {'limit': limit, 'offset': offset}
+
+    if dialect == 'postgresql':
+        """statement_timeout is reset at the end of the transaction."""
+        connection.execute(text('SET LOCAL statement_timeout = %i' %
+                                budget_ms))
+        params['query'] = query
+        try:
+            return [row[0] for row in
+                    connection.execute(POSTGRESQL_SEARCH, params)]
+
+        except OperationalError as e:
+            if 'statement timeout' in str(e):
+                raise SearchTimeout()
+            raise
+
+    if dialect == 'sqlite':
+        params['query'] = sqlite_match_query(query)
+        if not params['query']:
+            return []
+
+        """SQLite has no statement timeout, so the query is interrupted
+        from its progress handler once the budget is spent."""
+        deadline = time.time() + budget_ms / 1000.0
+        dbapi_connection = connection.connection
+        dbapi_connection.set_progress_handler(
+            lambda: time.time() > deadline, 1000)
+        try:
+            return [row[0] for row in
+                    connection.execute(SQLITE_SEARCH, params)]
+
+        except OperationalError as e:
+            if 'interrupted' in str(e):
+                raise SearchTimeout()
+            raise
+
+        finally:
+            dbapi_connection.set_progress_handler(None, 1000)
+
+    return like_search_ids(session, query, limit, offset)
+
+
+def search_items(session, query, page, per_page, budget_ms, columns=None):
+    """Returns the items on the given page (counting from 1) of the search
+    results, best match first, and whether there is a next page. The items
+    are loaded with their category, or as rows of the columns if given,
+    which have to include Item.id."""
+    ids = search_item_ids(session, query, per_page + 1,
+                          (page - 1) * per_page, budget_ms)
+    has_next = len(ids) > per_page
+    ids = ids[:per_page]
+    if not ids:
+        return [], False
+
+    if columns is None:
+        items = session.query(Item).options(joinedload(Item.category))
+    else:
+        items = session.query(*columns)
+    items = items.filter(Item.id.in_(ids)).all()
+    position = dict((item_id, i) for i, item_id in enumerate(ids))
+    items.sort(key=lambda item: position[item.id])
+    return items, has_next
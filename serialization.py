@@ -0,0 +1,100 @@
+"""Encoding of the JSON API's responses. Items and categories are read as
+plain column rows, without building ORM objects, and encoded as compact
+JSON by default, as indented JSON for people looking at the API in a
+browser, or as MessagePack for clients that send Accept:
+application/msgpack."""
+from flask import json
+from database_setup import Category, Item
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+"""Fields of a serialized item and category, the same as their serialize()
+methods return."""
+ITEM_FIELDS = ['id', 'title', 'description', 'category_id']
+CATEGORY_FIELDS = ['id', 'name']
+
+"""Indentation of the JSON sent to browsers."""
+PRETTY_INDENT = 2
+
+
+def item_columns():
+    """Returns the columns of a serialized item, to query them with."""
+    return [getattr(Item, field) for field in ITEM_FIELDS]
+
+
+def category_columns():
+    """Returns the columns of a serialized category, to query them with."""
+    return [getattr(Category, field) for field in CATEGORY_FIELDS]
+
+
+def item_dict(row):
+    """Serializes an item row queried with item_columns()."""
+    return dict(zip(ITEM_FIELDS, row))
+
+
+def category_dict(row):
+    """Serializes a category row queried with category_columns()."""
+    return dict(zip(CATEGORY_FIELDS, row))
+
+
+def negotiate(accept_mimetypes):
+    """Returns the (mimetype, indent) to answer a request with the accepted
+    mimetypes in: MessagePack if the client asks for it and the msgpack
+    module is installed, indented JSON if the client prefers HTML like a
+    browser does, and compact JSON otherwise."""
+    offered = [JSON, MSGPACK] if msgpack is not None else [JSON]
+    best = accept_mimetypes.best_match(offered + ['text/html'])
+    if best == 'text/html':
+        return JSON, PRETTY_INDENT
+    return best or JSON, None
+
+
+def dumps(data, mimetype, indent=None):
+    """Returns the data encoded as the mimetype."""
+    if mimetype == MSGPACK:
+        return msgpack.packb(data, use_bin_type=False)
+    if indent:
+        return json.dumps(data, indent=indent)
+    return json.dumps(data, separators=(',', ':'))
+
+
+def stream_list(key, count, blocks, mimetype, indent=None):
+    """Generates the document {key: [block, ...]} chunk by chunk, encoding
+    one block at a time. count has to be the number of blocks, which
+    MessagePack needs up front. The JSON is byte for byte the same as
+    dumps() of the whole document."""
+    if mimetype == MSGPACK:
+        packer = msgpack.Packer(use_bin_type=False)
+        yield packer.pack_map_header(1) + packer.pack(key) + \
+            packer.pack_array_header(count)
+        for block in blocks:
+            yield packer.pack(block)
+        return
+
+    """Dump a skeleton with two placeholders to pick up the exact opening,
+    separator and closing that the json module would use."""
+    placeholder = json.dumps('\0')
+    skeleton = dumps({key: ['\0', '\0']}, mimetype, indent)
+    head, separator, tail = skeleton.split(placeholder)
+    nesting = separator[separator.rfind('\n') + 1:] if indent else ''
+
+    first = True
+    for block in blocks:
+        block = dumps(block, mimetype, indent)
+        if nesting:
+            block = block.replace('\n', '\n' + nesting)
+
+        yield (head if first else separator) + block
+        first = False
+
+    if first:
+        yield dumps({key: []}, mimetype, indent)
+    else:
+        yield tail
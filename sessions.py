@@ -0,0 +1,202 @@
+"""Server-side sessions. The cookie only carries a random session id; the
+session data itself, including the pickled OAuth credentials, stays in a
+SQLite file or in redis and is only written back when it changes."""
+import os
+import re
+import sqlite3
+import threading
+import time
+import cPickle as pickle
+from werkzeug.datastructures import CallbackDict
+from flask.sessions import SessionInterface, SessionMixin
+
+
+"""Seconds between two sweeps of the expired sessions in one process."""
+PRUNE_INTERVAL = 600
+
+"""An unchanged session has its expiry pushed back at most this often, so
+browsing does not write the session on every request."""
+REFRESH_INTERVAL = 3600
+
+SESSION_ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def new_session_id():
+    """Returns a new random session id."""
+    return os.urandom(32).encode('hex')
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data loaded from a store. modified is set whenever the data
+    changes, new when there was no stored session for the request.
+    replaced_sid is the stored session that regenerate() moved the data
+    away from, to be deleted when the session is saved."""
+
+    def __init__(self, initial=None, sid=None, expires=None):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.new = sid is None
+        self.sid = sid or new_session_id()
+        self.expires = expires
+        self.modified = False
+        self.replaced_sid = None
+
+    def regenerate(self):
+        """Moves the data to a new session id. Call it whenever the user
+        logs in or out, so a session id planted in the browser beforehand
+        is worthless afterwards."""
+        if not self.new and self.replaced_sid is None:
+            self.replaced_sid = self.sid
+        self.sid = new_session_id()
+        self.modified = True
+
+
+class SQLiteStore(object):
+    """Keeps the sessions in a SQLite file, good for the workers of a single
+    machine. Every thread opens its own connection, again after a fork."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def connect(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS session (id TEXT PRIMARY KEY, '
+                'data BLOB NOT NULL, expires REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS '
+                               'session_expires_idx ON session (expires)')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def load(self, sid):
+        """Returns the (data, expires) of the session, or (None, None) if it
+        does not exist or has expired."""
+        row = self.connect().execute(
+            'SELECT data, expires FROM session WHERE id = ? AND expires > ?',
+            (sid, time.time())).fetchone()
+        if row is None:
+            return None, None
+        return pickle.loads(str(row[0])), row[1]
+
+    def save(self, sid, data, expires):
+        self.connect().execute(
+            'INSERT OR REPLACE INTO session (id, data, expires) '
+            'VALUES (?, ?, ?)',
+            (sid, sqlite3.Binary(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)),
+             expires))
+
+    def touch(self, sid, expires):
+        self.connect().execute('UPDATE session SET expires = ? WHERE id = ?',
+                               (expires, sid))
+
+    def delete(self, sid):
+        self.connect().execute('DELETE FROM session WHERE id = ?', (sid,))
+
+    def prune(self):
+        """Deletes the expired sessions. Returns how many there were."""
+        return self.connect().execute('DELETE FROM session WHERE expires <= ?',
+                                      (time.time(),)).rowcount
+
+
+class RedisStore(object):
+    """Keeps the sessions in redis, so that workers on several machines
+    share them. Redis drops the expired ones by itself."""
+
+    def __init__(self, url, prefix='catalog:session:'):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+
+    def load(self, sid):
+        """Returns the (data, expires) of the session, or (None, None) if it
+        does not exist or has expired."""
+        pipe = self.client.pipeline()
+        pipe.get(self.prefix + sid)
+        pipe.ttl(self.prefix + sid)
+        data, ttl = pipe.execute()
+        if data is None:
+            return None, None
+        return pickle.loads(data), time.time() + max(ttl, 0)
+
+    def save(self, sid, data, expires):
+        self.client.setex(self.prefix + sid, max(int(expires - time.time()), 1),
+                          pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+
+    def touch(self, sid, expires):
+        self.client.expire(self.prefix + sid,
+                           max(int(expires - time.time()), 1))
+
+    def delete(self, sid):
+        self.client.delete(self.prefix + sid)
+
+    def prune(self):
+        """Deletes the expired sessions. Returns how many there were."""
+        return 0
+
+
+def make_store(url):
+    """Returns the redis store for a redis:// url, or the SQLite store of
+    the file otherwise."""
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(url)
+    return SQLiteStore(url)
+
+
+class ServerSessionInterface(SessionInterface):
+    """Stores the sessions of the app in store. Sessions expire on the
+    server PERMANENT_SESSION_LIFETIME after they were last used. Empty
+    sessions are never stored, so visitors who are not logged in cost
+    nothing."""
+    session_class = ServerSession
+
+    def __init__(self, store):
+        self.store = store
+        self.pruned = time.time()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid and SESSION_ID_PATTERN.match(sid):
+            data, expires = self.store.load(sid)
+            if data is not None:
+                return self.session_class(data, sid=sid, expires=expires)
+        return self.session_class()
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.replaced_sid is not None:
+            self.store.delete(session.replaced_sid)
+
+        if not session:
+            if not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+
+        now = time.time()
+        lifetime = app.permanent_session_lifetime
+        expires = now + lifetime.days * 86400 + lifetime.seconds
+        if session.modified or session.new:
+            self.store.save(session.sid, dict(session), expires)
+        elif session.expires < expires - REFRESH_INTERVAL:
+            self.store.touch(session.sid, expires)
+        else:
+            return
+
+        response.set_cookie(app.session_cookie_name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            secure=self.get_cookie_secure(app),
+                            domain=domain, path=path)
+
+        if now - self.pruned > PRUNE_INTERVAL:
+            self.pruned = now
+            self.store.prune()
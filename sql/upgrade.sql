@@ -1,2 +1,26 @@
-DROP DATABASE IF EXISTS catalog;
-CREATE DATABASE catalog;
\ No newline at end of file
+-- Upgrades an existing catalog database in place. Every statement can be run
+-- again safely. Run it with `psql catalog -f sql/upgrade.sql`.
+
+-- Full-text search over item titles and descriptions.
+CREATE INDEX IF NOT EXISTS item_search_idx ON item
+    USING gin (to_tsvector('english', title || ' ' || description));
+
+-- Indexes for the category and owner scoped item queries.
+CREATE INDEX IF NOT EXISTS ix_item_category_id ON item (category_id);
+CREATE INDEX IF NOT EXISTS ix_item_user_id ON item (user_id);
+
+-- Denormalized per-category item counts, filled in from the items.
+ALTER TABLE category ADD COLUMN IF NOT EXISTS item_count integer NOT NULL
+    DEFAULT 0;
+UPDATE category SET item_count = (
+    SELECT count(*) FROM item WHERE item.category_id = category.id);
+
+-- Change feed read by /api/changes.
+CREATE TABLE IF NOT EXISTS change (
+    seq serial PRIMARY KEY,
+    kind varchar(16) NOT NULL,
+    object_id integer NOT NULL,
+    op varchar(8) NOT NULL,
+    created timestamp without time zone NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_change_created ON change (created);
@@ -0,0 +1,63 @@
+"""Compiling of the Jinja templates ahead of time. Compiled templates are
+kept in a bytecode cache directory that all the workers share, and
+`python ./manage.py build-templates` fills it at deploy time, so that no
+worker has to compile a template on its first requests."""
+import errno
+import hashlib
+import logging
+import os
+import tempfile
+from jinja2 import FileSystemBytecodeCache
+
+logger = logging.getLogger(__name__)
+
+
+class SharedBytecodeCache(FileSystemBytecodeCache):
+    """FileSystemBytecodeCache that creates its directory on first use and
+    replaces cache files atomically, so a worker never reads a file another
+    worker is still writing. A cache that cannot be written to only costs
+    the compile time it would have saved."""
+
+    def __init__(self, directory):
+        FileSystemBytecodeCache.__init__(self, directory, '%s.cache')
+
+    def dump_bytecode(self, bucket):
+        try:
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            fd, temp_path = tempfile.mkstemp(dir=self.directory,
+                                             prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    bucket.write_bytecode(f)
+                os.rename(temp_path, self._get_cache_filename(bucket))
+            except:
+                os.remove(temp_path)
+                raise
+
+        except (IOError, OSError) as e:
+            logger.warning('Could not write the compiled template to %s: %s',
+                           self.directory, e)
+
+
+def precompile(app):
+    """Loads every template of the app, compiling the ones that are not in
+    the bytecode cache yet, and keeps them in the app's template cache.
+    Returns how many templates there are."""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def source_digest(app):
+    """Returns a digest of the sources of every template of the app."""
+    digest = hashlib.sha1()
+    for name in sorted(app.jinja_env.list_templates()):
+        source = app.jinja_env.loader.get_source(app.jinja_env, name)[0]
+        digest.update(('%s\0%s\0' % (name, source)).encode('utf-8'))
+    return digest.hexdigest()
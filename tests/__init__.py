@@ -0,0 +1,79 @@
+"""Tests of the catalog app. Run them from the top of the repository with
+python -m unittest discover tests. They use SQLite files in a temporary
+directory and need no other services."""
+import os
+import shutil
+import tempfile
+from collections import Counter
+from sqlalchemy.orm import sessionmaker
+from catalog import create_app, get_resources
+from database_setup import Category, Item, User, create_schema
+
+
+class AppTestCase(object):
+    """Mixin for unittest.TestCase that makes a fresh app, with its
+    database, sessions and template cache in a temporary directory."""
+
+    config = {}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        config = {
+            'DATABASE_URL': 'sqlite:///' + os.path.join(self.directory,
+                                                        'catalog.db'),
+            'SESSION_STORE': os.path.join(self.directory, 'sessions.db'),
+            'TEMPLATE_CACHE_DIR': '',
+            'SECRET_KEY': 'test'
+        }
+        config.update(self.config)
+        self.app = create_app(config)
+        self.resources = get_resources(self.app)
+        create_schema(self.resources.engine)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def log_in(self, client, user_id=1, email='user@example.com'):
+        """Logs the test client in as the user, with the CSRF token 't'."""
+        with client.session_transaction() as login_session:
+            login_session['username'] = 'User'
+            login_session['email'] = email
+            login_session['picture'] = ''
+            login_session['user_id'] = user_id
+            login_session['csrf_token'] = 't'
+
+    def seed(self, categories=('Balls',), items=(), engine=None):
+        """Adds the user log_in logs in as, the categories, owned by that
+        user and numbered from 1, and the items, to the database of engine,
+        the app's primary by default. Items are titles, or dicts of Item
+        columns, and go in category 1 unless they say otherwise. The item
+        counts of the categories are kept."""
+        rows = []
+        for item in items:
+            values = {'description': 'Round', 'category_id': 1,
+                      'user_id': 1}
+            values.update(item if isinstance(item, dict) else
+                          {'title': item})
+            rows.append(values)
+        counts = Counter(values['category_id'] for values in rows)
+
+        db = sessionmaker(bind=engine or self.resources.engine)()
+        db.add(User(name='User', email='user@example.com'))
+        for category_id, name in enumerate(categories, 1):
+            db.add(Category(name=name, user_id=1,
+                            item_count=counts[category_id]))
+        db.flush()
+        for values in rows:
+            db.add(Item(**values))
+        db.commit()
+        db.close()
+
+    def add_item(self, client, title, category_id=1):
+        """Creates an item through the form, as the user the client is
+        logged in as."""
+        with client.session_transaction() as login_session:
+            login_session['csrf_token'] = 't'
+        response = client.post('/item/new/', data={
+            'title': title, 'description': 'Round',
+            'category': str(category_id), 'csrf_token': 't'})
+        self.assertEqual(response.status_code, 302)
@@ -0,0 +1,160 @@
+import json
+import os
+import unittest
+from sqlalchemy import event
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+import api
+from catalog import create_app, get_resources
+from database_setup import create_schema
+from tests import AppTestCase
+
+
+class ApiTierTest(AppTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(ApiTierTest, self).setUp()
+        self.seed(items=['Ball', 'Bat'])
+        self.flask = self.app.test_client()
+        self.tier_app = create_app(self.app.config)
+        self.tier = api.mount(self.tier_app)
+        self.client = Client(self.tier_app.wsgi_app, BaseResponse)
+
+    def test_answers_like_the_flask_views(self):
+        for url in ['/api/1/items/', '/api/1/items/?limit=1',
+                    '/api/1/item/', '/api/all/']:
+            for headers in [{}, {'Accept-Encoding': 'gzip'},
+                            {'Accept': 'text/html'}]:
+                expected = self.flask.get(url, headers=headers)
+                response = self.client.get(url, headers=headers)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data, expected.data)
+                self.assertEqual(response.headers['ETag'],
+                                 expected.headers['ETag'])
+
+                response = self.client.get(url, headers=dict(
+                    headers, **{'If-None-Match': expected.headers['ETag']}))
+                self.assertEqual(response.status_code, 304)
+
+    def test_runs_on_its_own_pool_and_counts_in_the_metrics(self):
+        statements = []
+        event.listen(self.tier.engines[0], 'before_cursor_execute',
+                     lambda *args: statements.append(args[2]))
+        self.client.get('/api/1/items/')
+        self.assertTrue(statements)
+
+        del statements[:]
+        self.assertIn('route="json_items"',
+                      self.client.get('/metrics').data)
+        self.client.get('/category/1/items/')
+        self.assertEqual(statements, [])
+
+    def test_standalone_tier_only_serves_the_api(self):
+        client = Client(api.ApiTier(self.app), BaseResponse)
+        self.assertEqual(json.loads(client.get('/api/1/item/').data)[
+            'item'][0]['title'], 'Ball')
+        self.assertEqual(client.get('/').status_code, 404)
+
+
+class ApiTierReplicaTest(AppTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(ApiTierReplicaTest, self).setUp()
+        self.seed(items=['Ball'])
+        self.tier_app = create_app(dict(
+            self.app.config, REPLICA_URLS='sqlite:///' + os.path.join(
+                self.directory, 'replica.db')))
+        self.tier = api.mount(self.tier_app)
+        create_schema(self.tier.engines[1][0])
+        self.seed(items=['Replicated ball'], engine=self.tier.engines[1][0])
+        self.client = Client(self.tier_app.wsgi_app, BaseResponse)
+
+    def test_reads_from_the_replica(self):
+        response = self.client.get('/api/1/items/')
+        self.assertEqual([item['title'] for item in json.loads(
+            response.data)['items']], ['Replicated ball'])
+        self.assertIsNot(self.tier.engines[1][0],
+                         get_resources(self.tier_app).replicas[0])
+
+
+class FakeMonkey(object):
+
+    @staticmethod
+    def is_module_patched(name):
+        return name == 'socket'
+
+
+class FakePsycopg2(object):
+
+    class extensions(object):
+        POLL_OK, POLL_READ, POLL_WRITE = range(3)
+        callbacks = []
+
+        @classmethod
+        def set_wait_callback(cls, callback):
+            cls.callbacks.append(callback)
+
+    class OperationalError(Exception):
+        pass
+
+
+class FakeConnection(object):
+
+    def __init__(self, states):
+        self.states = list(states)
+
+    def poll(self):
+        return self.states.pop(0)
+
+    def fileno(self):
+        return 7
+
+
+class GreenTest(AppTestCase, unittest.TestCase):
+    """The cooperative path, on a process gevent has patched."""
+
+    def setUp(self):
+        super(GreenTest, self).setUp()
+        self.seed(items=['Ball'])
+        self.patched = dict((name, getattr(api, name, None)) for name in
+                            ['monkey', 'psycopg2', 'wait_read', 'wait_write'])
+        self.waits = []
+        api.psycopg2 = FakePsycopg2
+        api.wait_read = lambda fd, timeout: self.waits.append(('read', fd))
+        api.wait_write = lambda fd, timeout: self.waits.append(('write', fd))
+        del FakePsycopg2.extensions.callbacks[:]
+
+    def tearDown(self):
+        for name, value in self.patched.items():
+            setattr(api, name, value)
+        super(GreenTest, self).tearDown()
+
+    def test_installs_the_wait_callback_once_per_worker(self):
+        api.monkey = FakeMonkey
+        tier = api.mount(create_app(self.app.config))
+        self.assertEqual(FakePsycopg2.extensions.callbacks,
+                         [api.wait_callback])
+
+        """A worker forked from a preloaded app, which gevent patches after
+        the tier was mounted."""
+        api.monkey = None
+        tier = api.mount(create_app(self.app.config))
+        api.monkey = FakeMonkey
+        tier.green.pid = None
+        client = Client(tier.app.wsgi_app, BaseResponse)
+        self.assertEqual(client.get('/').status_code, 200)
+        self.assertEqual(client.get('/api/1/items/').status_code, 200)
+        self.assertEqual(FakePsycopg2.extensions.callbacks,
+                         [api.wait_callback] * 2)
+
+    def test_wait_callback_waits_on_the_socket(self):
+        extensions = FakePsycopg2.extensions
+        api.wait_callback(FakeConnection([
+            extensions.POLL_READ, extensions.POLL_WRITE, extensions.POLL_OK]))
+        self.assertEqual(self.waits, [('read', 7), ('write', 7)])
+        self.assertRaises(FakePsycopg2.OperationalError, api.wait_callback,
+                          FakeConnection([9]))
+
+
+if __name__ == '__main__':
+    unittest.main()
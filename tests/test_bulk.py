@@ -0,0 +1,53 @@
+import json
+import os
+import unittest
+from sqlalchemy.orm import sessionmaker
+from bulk import parse_row
+from catalog import image_path
+from database_setup import Item
+from tests import AppTestCase
+
+STORED = 'a' * 64 + '.png'
+
+
+class ParseRowTest(unittest.TestCase):
+
+    def parse(self, image_url):
+        return parse_row(json.dumps({
+            'title': 'Ball', 'description': 'Round', 'category_id': 1,
+            'image_url': image_url}), set([1]))
+
+    def test_image_url_must_be_a_stored_image(self):
+        self.assertEqual(self.parse(STORED)['image_url'], STORED)
+        self.assertEqual(self.parse(None)['image_url'], None)
+        for image_url in ['../../../etc/passwd', '/etc/passwd', 'ball.png',
+                          'a' * 64 + '.exe', 'sub/' + STORED, 1]:
+            self.assertRaises(ValueError, self.parse, image_url)
+
+
+class ImagePathTest(AppTestCase, unittest.TestCase):
+
+    def test_paths_outside_of_the_images_directory_are_refused(self):
+        with self.app.app_context():
+            self.assertEqual(os.path.basename(image_path(STORED)), STORED)
+            for name in ['../x', '../../../rv/victim.txt', '/etc/passwd']:
+                self.assertRaises(ValueError, image_path, name)
+
+    def test_deleting_an_item_keeps_files_outside_of_the_images(self):
+        victim = os.path.join(self.directory, 'victim.txt')
+        open(victim, 'w').close()
+        self.seed(items=[{'title': 'Ball', 'image_url': os.path.relpath(
+            victim, self.resources.images_path)}])
+
+        client = self.app.test_client()
+        self.log_in(client)
+        self.assertEqual(client.post('/item/1/delete').status_code, 302)
+        self.resources.image_cleaner.join()
+        self.assertTrue(os.path.exists(victim))
+        db = sessionmaker(bind=self.resources.engine)()
+        self.assertEqual(db.query(Item).count(), 0)
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
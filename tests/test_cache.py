@@ -0,0 +1,44 @@
+import unittest
+from cache import CachedItem, LatestItems
+
+
+def item(item_id, title='Ball'):
+    return CachedItem(item_id, title, None, 1, 'Balls')
+
+
+class LatestItemsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [item(2), item(1)]
+        self.loads = 0
+        self.latest = LatestItems('latest_items', self.load, size=2, spare=1)
+
+    def load(self, limit):
+        self.loads += 1
+        return self.rows[:limit]
+
+    def test_item_already_loaded_is_not_listed_twice(self):
+        """The reload ran after the item was committed, before add."""
+        self.latest.get()
+        self.rows.insert(0, item(3))
+        self.latest.invalidate()
+        self.assertEqual([listed.id for listed in self.latest.get()], [3, 2])
+
+        self.latest.add(item(3, 'New ball'))
+        self.assertEqual([(listed.id, listed.title) for listed in
+                          self.latest.get()], [(3, 'New ball'), (2, 'Ball')])
+        self.assertEqual(len(self.latest.items), 3)
+
+    def test_items_are_loaded_again_after_the_ttl(self):
+        """Writes of other workers are not announced without redis."""
+        self.latest.get()
+        self.rows.insert(0, item(3))
+        self.assertEqual([listed.id for listed in self.latest.get()], [2, 1])
+
+        self.latest.loaded_at -= self.latest.ttl
+        self.assertEqual([listed.id for listed in self.latest.get()], [3, 2])
+        self.assertEqual(self.loads, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
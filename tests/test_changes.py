@@ -0,0 +1,94 @@
+import json
+import unittest
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+import changes
+from tests import AppTestCase
+
+
+class RecordingSession(object):
+    """Stands in for a session on PostgreSQL, keeping what it runs."""
+
+    class Bind(object):
+        dialect = postgresql.dialect()
+
+    def __init__(self):
+        self.statements = []
+
+    def get_bind(self):
+        return self.Bind()
+
+    def execute(self, statement):
+        self.statements.append(str(statement.compile(
+            dialect=postgresql.dialect())))
+
+
+class ChangesTest(AppTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(ChangesTest, self).setUp()
+        self.seed(categories=['Balls', 'Bats'])
+        self.client = self.app.test_client()
+        self.log_in(self.client)
+
+    def get_changes(self, since):
+        return json.loads(
+            self.client.get('/api/changes?since=%i' % since).data)
+
+    def test_committed_changes_are_in_the_feed_at_once(self):
+        self.add_item(self.client, 'Ball')
+        page = self.get_changes(0)
+        self.assertEqual([(change['kind'], change['op'], change['data']['title'])
+                          for change in page['changes']],
+                         [('item', 'upsert', 'Ball')])
+
+        self.add_item(self.client, 'Bat')
+        page = self.get_changes(page['next'])
+        self.assertEqual([change['data']['title']
+                          for change in page['changes']], ['Bat'])
+        self.assertFalse(page['more'])
+
+    def test_writes_take_the_feed_lock_before_any_update(self):
+        """Writers that took the lock and the rows in different orders
+        could deadlock on PostgreSQL."""
+        self.add_item(self.client, 'Ball')
+        events = []
+        lock_feed = changes.lock_feed
+
+        def record_lock(session):
+            session.flush()
+            events.append('lock')
+            lock_feed(session)
+
+        def record_write(conn, cursor, statement, *args):
+            if statement.startswith(('UPDATE', 'DELETE')):
+                events.append(statement.split()[0])
+
+        event.listen(self.resources.engine, 'before_cursor_execute',
+                     record_write)
+        changes.lock_feed = record_lock
+        try:
+            for url, data in [
+                    ('/item/1/edit/', {'title': 'Ball', 'category': '2',
+                                       'description': 'Round'}),
+                    ('/item/1/delete', {})]:
+                del events[:]
+                with self.client.session_transaction() as login_session:
+                    login_session['csrf_token'] = 't'
+                data['csrf_token'] = 't'
+                self.assertEqual(self.client.post(url, data=data).status_code,
+                                 302)
+                self.assertEqual(events[0], 'lock')
+                self.assertIn(events[1], ['UPDATE', 'DELETE'])
+        finally:
+            changes.lock_feed = lock_feed
+
+    def test_writers_hold_the_feed_lock_on_postgresql(self):
+        session = RecordingSession()
+        changes.lock_feed(session)
+        self.assertEqual(len(session.statements), 1)
+        self.assertIn('SELECT pg_advisory_xact_lock(', session.statements[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
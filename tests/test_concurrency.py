@@ -0,0 +1,88 @@
+import threading
+import unittest
+from sqlalchemy.orm import sessionmaker
+from catalog import session
+from database_setup import Category, Item
+from tests import AppTestCase
+
+THREADS = 8
+REQUESTS = 10
+
+
+class ConcurrencyTest(AppTestCase, unittest.TestCase):
+    """Runs requests from several threads at once against a SQLite file, the
+    way the threaded dev server and threaded workers do."""
+
+    def setUp(self):
+        super(ConcurrencyTest, self).setUp()
+        self.seed()
+
+    def run_threads(self, work):
+        errors = []
+
+        def run(number):
+            try:
+                work(number)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(number,))
+                   for number in xrange(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_each_app_context_gets_its_own_session(self):
+        sessions = []
+        lock = threading.Lock()
+        barrier = threading.Semaphore(0)
+
+        def work(number):
+            with self.app.app_context():
+                with lock:
+                    sessions.append(session())
+                    if len(sessions) == THREADS:
+                        for _ in xrange(THREADS):
+                            barrier.release()
+                """Hold the context until every thread has its session, so
+                none of them can be reused."""
+                barrier.acquire()
+
+        self.run_threads(work)
+        self.assertEqual(len(set(map(id, sessions))), THREADS)
+
+    def test_parallel_reads_and_writes(self):
+        statuses = []
+
+        def work(number):
+            client = self.app.test_client()
+            self.log_in(client)
+            for request in xrange(REQUESTS):
+                statuses.append(client.get('/').status_code)
+                statuses.append(client.get('/api/all/').status_code)
+                statuses.append(client.get('/category/1/items/').status_code)
+
+                with client.session_transaction() as login_session:
+                    login_session['csrf_token'] = 't'
+                response = client.post('/item/new/', data={
+                    'title': 'Ball %i-%i' % (number, request),
+                    'description': 'Round', 'category': '1',
+                    'csrf_token': 't'})
+                statuses.append(response.status_code)
+                self.assertEqual(response.headers['Location'],
+                                 'http://localhost/')
+
+        self.run_threads(work)
+        self.assertEqual(set(statuses), set([200, 302]))
+
+        db = sessionmaker(bind=self.resources.engine)()
+        self.assertEqual(db.query(Item).count(), THREADS * REQUESTS)
+        self.assertEqual(db.query(Category).one().item_count,
+                         THREADS * REQUESTS)
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import json
+import os
+import unittest
+from sqlalchemy.orm import sessionmaker
+from assets import StaticAssets
+from catalog import create_app
+from database_setup import Item
+from tests import AppTestCase
+
+
+class ConditionalTest(AppTestCase, unittest.TestCase):
+    """ETags of two workers of the same deployment, without redis."""
+
+    def setUp(self):
+        super(ConditionalTest, self).setUp()
+        self.seed()
+        self.other_app = create_app(self.app.config)
+        self.writer = self.app.test_client()
+        self.reader = self.other_app.test_client()
+        self.log_in(self.writer)
+
+    def test_unchanged_data_is_not_sent_again(self):
+        self.add_item(self.writer, 'Ball')
+        response = self.reader.get('/api/1/items/')
+        etag = response.headers['ETag']
+        response = self.reader.get('/api/1/items/',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_write_in_one_worker_changes_the_etag_of_the_other(self):
+        self.add_item(self.writer, 'Ball')
+        etag = self.reader.get('/api/1/items/').headers['ETag']
+
+        self.add_item(self.writer, 'Bat')
+        response = self.reader.get('/api/1/items/',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual([item['title'] for item in
+                          json.loads(response.data)['items']],
+                         ['Ball', 'Bat'])
+
+    def test_home_page_etag_matches_the_cached_copy_served(self):
+        response = self.reader.get('/')
+        etag = response.headers['ETag']
+        self.assertEqual(self.reader.get(
+            '/', headers={'If-None-Match': etag}).status_code, 304)
+
+        """The reader's caches do not see the write yet, and neither does
+        its ETag, so the client is not told the old page is the new one."""
+        self.add_item(self.writer, 'Ball')
+        self.assertEqual(self.reader.get(
+            '/', headers={'If-None-Match': etag}).status_code, 304)
+
+        resources = self.other_app.extensions['catalog']
+        resources.category_cache.generation = None
+        resources.latest_items.generation = None
+        response = self.reader.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Ball', response.data)
+
+    def test_home_page_etag_changes_once_the_thumbnail_is_ready(self):
+        images = os.path.join(self.directory, 'images')
+        os.mkdir(images)
+        resources = self.other_app.extensions['catalog']
+        resources.images_path = resources.image_processor.directory = images
+        name = 'a' * 64
+        open(os.path.join(images, name + '.png'), 'wb').close()
+        db = sessionmaker(bind=self.resources.engine)()
+        db.add(Item(title='Ball', description='Round', category_id=1,
+                    user_id=1, image_url=name + '.png'))
+        db.commit()
+        db.close()
+
+        response = self.reader.get('/')
+        self.assertIn(name + '.png', response.data)
+        etag = response.headers['ETag']
+
+        open(os.path.join(images, name + '-thumb.png'), 'wb').close()
+        response = self.reader.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(name + '-thumb.png', response.data)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_home_page_etag_changes_with_the_deploy(self):
+        static = os.path.join(self.directory, 'static')
+        os.mkdir(static)
+        with open(os.path.join(static, 'style.css'), 'w') as f:
+            f.write('body {}')
+        resources = self.other_app.extensions['catalog']
+        resources.static_assets = StaticAssets(static)
+        etag = self.reader.get('/').headers['ETag']
+
+        """A deploy changes the file and restarts the workers."""
+        with open(os.path.join(static, 'style.css'), 'w') as f:
+            f.write('body { margin: 0 }')
+        resources.static_assets = StaticAssets(static)
+        resources._deploy_version = None
+        self.assertEqual(self.reader.get(
+            '/', headers={'If-None-Match': etag}).status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import base64
+import json
+import os
+import threading
+import time
+import unittest
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import requests
+from google_auth import GoogleClient
+from tests import AppTestCase
+
+
+class StubGoogle(ThreadingMixIn, HTTPServer):
+    """Answers like Google's OAuth endpoints, after delay seconds."""
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.delay = 0
+        self.calls = []
+        self.url = 'http://127.0.0.1:%i' % self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        """Clients that timed out have hung up before the answer."""
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, data):
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.server.calls.append('/token')
+        id_token = 'x.%s.y' % base64.urlsafe_b64encode(
+            json.dumps({'sub': 'g1'})).rstrip('=')
+        self.reply({'access_token': 'token', 'token_type': 'Bearer',
+                    'expires_in': 3600, 'id_token': id_token})
+
+    def do_GET(self):
+        path = urlparse.urlparse(self.path).path
+        self.server.calls.append(path)
+        time.sleep(self.server.delay)
+        if path == '/tokeninfo':
+            self.reply({'user_id': 'g1', 'issued_to': 'client'})
+        elif path == '/userinfo':
+            self.reply({'name': 'Stub', 'picture': '', 'email': 'stub@x'})
+        else:
+            self.reply({})
+
+
+class GoogleClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.google = StubGoogle()
+        self.client = GoogleClient(
+            timeout=0.5, pool_size=2,
+            tokeninfo_url=self.google.url + '/tokeninfo',
+            userinfo_url=self.google.url + '/userinfo',
+            revoke_url=self.google.url + '/revoke')
+
+    def tearDown(self):
+        self.google.stop()
+
+    def test_tokeninfo_is_cached(self):
+        self.assertEqual(self.client.tokeninfo('token')['user_id'], 'g1')
+        self.assertEqual(self.client.tokeninfo('token')['user_id'], 'g1')
+        self.assertEqual(self.google.calls, ['/tokeninfo'])
+
+        self.client.forget('token')
+        self.client.tokeninfo('token')
+        self.assertEqual(self.google.calls, ['/tokeninfo', '/tokeninfo'])
+
+    def test_slow_google_times_out(self):
+        self.google.delay = 2
+        started = time.time()
+        self.assertRaises(requests.RequestException,
+                          self.client.tokeninfo, 'token')
+        self.assertLess(time.time() - started, 1.5)
+
+    def test_check_token_asks_for_both_at_once(self):
+        self.google.delay = 0.3
+        started = time.time()
+        tokeninfo, userinfo = self.client.check_token('token')
+        self.assertLess(time.time() - started, 0.55)
+        self.assertEqual(tokeninfo['user_id'], 'g1')
+        self.assertEqual(userinfo['email'], 'stub@x')
+
+
+class GoogleLoginTest(AppTestCase, unittest.TestCase):
+
+    def setUp(self):
+        self.google = StubGoogle()
+        self.config = {
+            'OAUTH_TIMEOUT': 0.5,
+            'GOOGLE_TOKENINFO_URL': self.google.url + '/tokeninfo',
+            'GOOGLE_USERINFO_URL': self.google.url + '/userinfo',
+            'GOOGLE_REVOKE_URL': self.google.url + '/revoke'
+        }
+        super(GoogleLoginTest, self).setUp()
+        secrets = os.path.join(self.directory, 'client_secrets.json')
+        with open(secrets, 'w') as f:
+            json.dump({'web': {
+                'client_id': 'client', 'client_secret': 'secret',
+                'auth_uri': self.google.url + '/auth',
+                'token_uri': self.google.url + '/token',
+                'redirect_uris': []}}, f)
+        self.app.config.update(CLIENT_SECRETS=secrets)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        super(GoogleLoginTest, self).tearDown()
+        self.google.stop()
+
+    def connect(self):
+        with self.client.session_transaction() as login_session:
+            login_session['csrf_token'] = 't'
+        return self.client.post('/gconnect?csrf_token=t', data='code')
+
+    def test_login(self):
+        response = self.connect()
+        self.assertEqual(response.status_code, 200)
+        with self.client.session_transaction() as login_session:
+            self.assertEqual(login_session['email'], 'stub@x')
+
+    def session_id(self):
+        for cookie in self.client.cookie_jar:
+            if cookie.name == self.app.session_cookie_name:
+                return cookie.value
+
+    def test_login_and_logout_issue_a_new_session_id(self):
+        with self.client.session_transaction() as login_session:
+            login_session['csrf_token'] = 't'
+        planted = self.session_id()
+        store = self.app.session_interface.store
+
+        self.assertEqual(self.connect().status_code, 200)
+        logged_in = self.session_id()
+        self.assertNotEqual(logged_in, planted)
+        self.assertEqual(store.load(planted), (None, None))
+        self.assertEqual(store.load(logged_in)[0]['email'], 'stub@x')
+
+        self.assertEqual(self.client.get('/logout/').status_code, 302)
+        self.assertNotEqual(self.session_id(), logged_in)
+        self.assertEqual(store.load(logged_in), (None, None))
+
+    def test_slow_google_answers_504(self):
+        self.google.delay = 2
+        self.assertEqual(self.connect().status_code, 504)
+
+
+if __name__ == '__main__':
+    unittest.main()
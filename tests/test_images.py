@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+from cleanup import FileCleaner
+from images import store_upload
+
+
+class Upload(object):
+    def __init__(self, data):
+        self.stream = StringIO(data)
+
+
+class FileCleanerTest(unittest.TestCase):
+    """Removal of stored images that a new upload may take up again."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cleaner = FileCleaner(grace=60)
+        self.name = store_upload(Upload('image'), self.directory, 'png')
+        self.paths = [os.path.join(self.directory, 'thumb-' + self.name),
+                      os.path.join(self.directory, self.name)]
+        open(self.paths[0], 'wb').write('thumb')
+        self.age(self.paths)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def age(self, paths):
+        old = time.time() - 3600
+        for path in paths:
+            os.utime(path, (old, old))
+
+    def remaining(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_unused_files_are_removed(self):
+        self.cleaner.remove(self.paths, in_use=lambda: False)
+        self.cleaner.join()
+        self.assertEqual(self.remaining(), [])
+
+    def test_files_in_use_are_kept(self):
+        self.cleaner.remove(self.paths, in_use=lambda: True)
+        self.cleaner.join()
+        self.assertEqual(self.remaining(),
+                         sorted([self.name, 'thumb-' + self.name]))
+
+    def test_upload_before_the_check_keeps_the_files(self):
+        store_upload(Upload('image'), self.directory, 'png')
+        self.cleaner.remove(self.paths, in_use=lambda: False)
+        self.cleaner.join()
+        self.assertEqual(self.remaining(),
+                         sorted([self.name, 'thumb-' + self.name]))
+
+    def test_upload_during_the_check_is_not_removed(self):
+        def in_use():
+            """The upload has stored its file but not committed yet."""
+            store_upload(Upload('image'), self.directory, 'png')
+            return False
+
+        self.cleaner.remove(self.paths, in_use=in_use)
+        self.cleaner.join()
+        self.assertEqual(self.remaining(), [self.name])
+
+    def test_failing_check_keeps_the_files(self):
+        def in_use():
+            raise IOError('database is down')
+
+        self.cleaner.remove(self.paths, in_use=in_use)
+        self.cleaner.join()
+        self.assertEqual(self.remaining(),
+                         sorted([self.name, 'thumb-' + self.name]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import json
+import unittest
+from sqlalchemy.orm import sessionmaker
+from database_setup import Item
+from tests import AppTestCase
+
+BODY = json.dumps({'title': 'Ball', 'description': 'Round',
+                   'category_id': 1}) + '\n'
+
+
+class ImportTest(AppTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(ImportTest, self).setUp()
+        self.seed()
+        self.client = self.app.test_client()
+        self.log_in(self.client)
+
+    def items(self):
+        db = sessionmaker(bind=self.resources.engine)()
+        try:
+            return db.query(Item).count()
+        finally:
+            db.close()
+
+    def post(self, headers, content_type='application/json'):
+        return self.client.post('/api/import', data=BODY, headers=headers,
+                                content_type=content_type)
+
+    def test_import_with_csrf_token(self):
+        token = json.loads(self.client.get('/api/csrf-token').data)
+        response = self.post({'X-CSRF-Token': token['csrf_token']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['imported'], 1)
+        self.assertEqual(self.items(), 1)
+
+    def test_cross_site_form_post_is_refused(self):
+        self.assertEqual(self.post({}, 'text/plain').status_code, 403)
+        self.assertEqual(self.post({}).status_code, 403)
+        self.assertEqual(self.post({'X-CSRF-Token': 'x'}).status_code, 403)
+        self.assertEqual(self.items(), 0)
+
+    def test_body_must_be_json(self):
+        response = self.post({'X-CSRF-Token': 't'}, 'text/plain')
+        self.assertEqual(response.status_code, 415)
+        response = self.post({'X-CSRF-Token': 't'},
+                             'application/x-www-form-urlencoded')
+        self.assertEqual(response.status_code, 415)
+        self.assertEqual(self.items(), 0)
+
+    def test_token_requires_login(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/api/csrf-token').status_code, 401)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+from database_setup import Category
+from tests import AppTestCase
+
+
+class ItemCountTest(AppTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(ItemCountTest, self).setUp()
+        self.seed(categories=['Balls', 'Bats'],
+                  items=['Ball', {'title': 'Bat', 'category_id': 2}])
+        self.client = self.app.test_client()
+        self.log_in(self.client)
+
+    def counts(self):
+        db = sessionmaker(bind=self.resources.engine)()
+        try:
+            return [category.item_count for category in
+                    db.query(Category).order_by(Category.id)]
+        finally:
+            db.close()
+
+    def move(self, item_id, category_id):
+        with self.client.session_transaction() as login_session:
+            login_session['csrf_token'] = 't'
+        response = self.client.post('/item/%i/edit/' % item_id, data={
+            'title': 'Moved', 'description': 'Moved',
+            'category': str(category_id), 'csrf_token': 't'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_moves_update_the_counts_in_category_id_order(self):
+        updated = []
+
+        def record_update(conn, cursor, statement, parameters, *args):
+            if statement.startswith('UPDATE category'):
+                updated.append(parameters[-1])
+
+        event.listen(self.resources.engine, 'before_cursor_execute',
+                     record_update)
+        self.move(1, 2)
+        self.assertEqual(self.counts(), [0, 2])
+        self.move(2, 1)
+        self.assertEqual(self.counts(), [1, 1])
+        self.assertEqual(updated, [1, 2, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import json
+import unittest
+from catalog import MAX_BATCH_IDS, MAX_PAGE_SIZE, encode_cursor
+from tests import AppTestCase
+
+
+class JsonAllTest(AppTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(JsonAllTest, self).setUp()
+        self.seed(categories=['Balls', 'Bats', 'Nets'], items=[
+            {'title': title, 'category_id': category_id}
+            for title, category_id in [('Lost', None), ('Ball', 1),
+                                       ('Bat', 2), ('Club', 2)]])
+        self.client = self.app.test_client()
+
+    def test_every_category_lists_its_items(self):
+        """Items without a category sort first on SQLite and belong to no
+        category."""
+        result = json.loads(self.client.get('/api/all/').data)['result']
+        self.assertEqual(
+            [(block['category']['name'],
+              [item['title'] for item in block['items']])
+             for block in result],
+            [('Balls', ['Ball']), ('Bats', ['Bat', 'Club']), ('Nets', [])])
+
+
+class PaginationTest(AppTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(PaginationTest, self).setUp()
+        self.seed(categories=['Balls', 'Bats'], items=[
+            {'title': title, 'category_id': category_id}
+            for title, category_id in [('Ball 1', 1), ('Bat', 2),
+                                       ('Ball 2', 1), ('Ball 3', 1),
+                                       ('Club', 2), ('Ball 4', 1),
+                                       ('Ball 5', 1)]])
+        self.client = self.app.test_client()
+
+    def get_pages(self, url):
+        """Returns the titles of every page, following the next cursors."""
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data)
+            pages.append([item['title'] for item in data['items']])
+            url = data['next'] and '/api/1/items/?limit=2&next=' + data['next']
+        return pages
+
+    def test_api_pages_follow_the_cursor(self):
+        self.assertEqual(self.get_pages('/api/1/items/?limit=2'), [
+            ['Ball 1', 'Ball 2'], ['Ball 3', 'Ball 4'], ['Ball 5']])
+        self.assertEqual(self.get_pages('/api/1/items/?limit=5'), [
+            ['Ball 1', 'Ball 2', 'Ball 3', 'Ball 4', 'Ball 5']])
+        self.assertEqual(
+            self.get_pages('/api/1/items/?limit=%i' % MAX_PAGE_SIZE),
+            [['Ball 1', 'Ball 2', 'Ball 3', 'Ball 4', 'Ball 5']])
+
+        """A cursor points past an item id, not at a position."""
+        data = json.loads(self.client.get(
+            '/api/1/items/?next=' + encode_cursor(4)).data)
+        self.assertEqual([item['title'] for item in data['items']],
+                         ['Ball 4', 'Ball 5'])
+        self.assertIsNone(data['next'])
+
+        self.assertNotIn('next', json.loads(
+            self.client.get('/api/1/items/').data))
+
+    def test_api_rejects_invalid_pages(self):
+        for query in ['limit=0', 'limit=-1', 'limit=%i' % (MAX_PAGE_SIZE + 1),
+                      'limit=ten', 'next=!!!', 'next=YWJj',
+                      'next=' + encode_cursor(-1), 'next=%C3%A9',
+                      'limit=2&next=' + encode_cursor('2.5')]:
+            response = self.client.get('/api/1/items/?' + query)
+            self.assertEqual(response.status_code, 400, query)
+            self.assertIn('error', json.loads(response.data))
+
+    def test_category_page_links_the_next_page(self):
+        response = self.client.get('/category/1/items/?limit=2')
+        self.assertIn('Ball 2', response.data)
+        self.assertNotIn('Ball 3', response.data)
+        self.assertIn('next=' + encode_cursor(3), response.data)
+
+        response = self.client.get(
+            '/category/1/items/?limit=2&next=' + encode_cursor(6))
+        self.assertIn('Ball 5', response.data)
+        self.assertNotIn('Ball 4', response.data)
+        self.assertNotIn('More items', response.data)
+
+    def test_category_page_shows_everything_on_an_invalid_page(self):
+        for query in ['limit=0', 'limit=%i' % (MAX_PAGE_SIZE + 1),
+                      'next=!!!', 'next=' + encode_cursor(-1)]:
+            response = self.client.get('/category/1/items/?' + query)
+            self.assertEqual(response.status_code, 302, query)
+            self.assertTrue(response.headers['Location'].endswith(
+                '/category/1/items/'))
+
+
+class BatchTest(AppTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        self.seed(items=['Ball', 'Bat', 'Club'])
+        self.client = self.app.test_client()
+
+    def post(self, body):
+        return self.client.post('/api/items', data=json.dumps(body),
+                                content_type='application/json')
+
+    def test_answers_in_the_requested_order(self):
+        for response in [self.client.get('/api/items?ids=3,1,99,3, 1,'),
+                         self.post({'ids': [3, 1, 99, 3, '1']})]:
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data)
+            self.assertEqual([(item['id'], item['title'])
+                              for item in data['items']],
+                             [(3, 'Club'), (1, 'Ball')])
+            self.assertEqual(data['missing'], [99])
+
+    def test_fetches_at_most_max_batch_ids(self):
+        ids = range(1, MAX_BATCH_IDS + 1)
+        for response in [
+                self.client.get('/api/items?ids=' + ','.join(
+                    str(item_id) for item_id in ids + [1])),
+                self.post({'ids': ids + [1]})]:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(json.loads(response.data)['missing']),
+                             MAX_BATCH_IDS - 3)
+
+        for response in [
+                self.client.get('/api/items?ids=' + ','.join(
+                    str(item_id) for item_id in ids + [0])),
+                self.post({'ids': ids + [0]})]:
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('at most', json.loads(response.data)['error'])
+
+    def test_rejects_invalid_ids(self):
+        for response in [self.client.get('/api/items'),
+                         self.client.get('/api/items?ids=,'),
+                         self.client.get('/api/items?ids=1,ball'),
+                         self.client.get('/api/items?ids=1.5'),
+                         self.post({'ids': [True]}),
+                         self.post({'ids': [1, False]}),
+                         self.post({'ids': [1.5]}),
+                         self.post({'ids': [1.0]}),
+                         self.post({'ids': [None]}),
+                         self.post({'ids': [[1]]}),
+                         self.post({'ids': []}),
+                         self.post({'ids': '1,2'}),
+                         self.post({'id': [1]}),
+                         self.post([1, 2]),
+                         self.client.post('/api/items', data='{ids')]:
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', json.loads(response.data))
+
+
+if __name__ == '__main__':
+    unittest.main()
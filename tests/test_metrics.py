@@ -0,0 +1,38 @@
+import unittest
+from flask import g
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+import metrics
+from tests import AppTestCase
+
+
+class InstrumentEngineTest(AppTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(InstrumentEngineTest, self).setUp()
+        self.engine = create_engine('sqlite://')
+        metrics.instrument_engine(self.engine)
+
+    def test_failed_statements_are_counted_and_not_kept(self):
+        connection = self.engine.connect()
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            for _ in xrange(3):
+                self.assertRaises(OperationalError, connection.execute,
+                                  'SELECT * FROM missing')
+            connection.execute('SELECT 1')
+            self.assertEqual(g.metrics_sql_statements, 4)
+        self.assertNotIn('metrics_started', connection.info)
+        connection.close()
+
+    def test_statements_outside_requests_are_not_counted(self):
+        connection = self.engine.connect()
+        self.assertRaises(OperationalError, connection.execute,
+                          'SELECT * FROM missing')
+        connection.execute('SELECT 1')
+        self.assertNotIn('metrics_started', connection.info)
+        connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
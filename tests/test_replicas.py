@@ -0,0 +1,62 @@
+import json
+import os
+import unittest
+from catalog import create_app, get_resources
+from database_setup import Change, Item, create_schema
+from tests import AppTestCase
+
+
+class LaggingReplicaTest(AppTestCase, unittest.TestCase):
+    """Reads of a worker with a replica that has not caught up with the
+    primary yet."""
+
+    def setUp(self):
+        super(LaggingReplicaTest, self).setUp()
+        self.reader = create_app(dict(
+            self.app.config, REPLICA_URLS='sqlite:///' + os.path.join(
+                self.directory, 'replica.db')))
+        self.replica = get_resources(self.reader).replicas[0]
+        create_schema(self.replica)
+        self.seed()
+        self.seed(engine=self.replica)
+
+        self.writer = self.app.test_client()
+        self.log_in(self.writer)
+        self.client = self.reader.test_client()
+
+    def replicate(self):
+        """Brings the replica up to date with the primary."""
+        for table in [Item.__table__, Change.__table__]:
+            rows = [dict(row) for row in
+                    self.resources.engine.execute(table.select())]
+            self.replica.execute(table.delete())
+            self.replica.execute(table.insert(), rows)
+
+    def get_items(self, etag=None):
+        response = self.client.get('/api/1/items/', headers={
+            'If-None-Match': etag} if etag else {})
+        titles = [item['title'] for item in json.loads(response.data)[
+            'items']] if response.status_code == 200 else None
+        return response.status_code, response.headers['ETag'], titles
+
+    def test_stale_body_is_not_sent_under_the_new_etag(self):
+        self.add_item(self.writer, 'Ball')
+        self.replicate()
+        status, etag, titles = self.get_items()
+        self.assertEqual(titles, ['Ball'])
+
+        self.add_item(self.writer, 'Bat')
+        status, lagging_etag, titles = self.get_items(etag)
+        self.assertEqual(status, 304)
+        self.assertEqual(lagging_etag, etag)
+
+        self.replicate()
+        status, new_etag, titles = self.get_items(etag)
+        self.assertEqual(status, 200)
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(titles, ['Ball', 'Bat'])
+        self.assertEqual(self.get_items(new_etag)[0], 304)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+from sqlalchemy.orm import sessionmaker
+from search import like_search_ids, search_items
+from tests import AppTestCase
+
+
+class SearchTest(AppTestCase, unittest.TestCase):
+
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        self.seed(items=[{'title': title, 'description': description}
+                         for title, description in [
+                             ('Red ball', 'Bouncy'),
+                             ('Blue ball', 'Not bouncy'),
+                             ('Bat', 'Made of wood'),
+                             ('Bat_2', 'Spare')]])
+        self.db = sessionmaker(bind=self.resources.engine)()
+
+    def tearDown(self):
+        self.db.close()
+        super(SearchTest, self).tearDown()
+
+    def test_full_text_search(self):
+        items, has_next = search_items(self.db, 'bouncy ball', 1, 10, 1000)
+        self.assertEqual(sorted(item.title for item in items),
+                         ['Blue ball', 'Red ball'])
+        self.assertFalse(has_next)
+
+    def test_like_fallback_matches_every_word(self):
+        self.assertEqual(like_search_ids(self.db, 'BALL not', 10, 0), [2])
+        self.assertEqual(like_search_ids(self.db, 'ball', 1, 1), [2])
+        self.assertEqual(like_search_ids(self.db, '%', 10, 0), [])
+
+    def test_like_fallback_escapes_wildcards(self):
+        self.assertEqual(like_search_ids(self.db, 't_2', 10, 0), [4])
+        self.assertEqual(like_search_ids(self.db, 'a_e', 10, 0), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
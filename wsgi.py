@@ -0,0 +1,15 @@
+"""Entry point for WSGI servers, e.g. gunicorn --preload wsgi:app. Creating
+the app does not connect to the database, so it can be preloaded before the
+workers are forked and each of them still opens its own connections. The
+templates are loaded up front, so preloaded workers start with them
+compiled. With CATALOG_API_TIER set, the read-only API is served by api.py,
+e.g. CATALOG_API_TIER=1 gunicorn -k gevent --worker-connections 2000
+wsgi:app."""
+from catalog import create_app
+import api
+import templating
+
+app = create_app()
+if app.config['API_TIER']:
+    api.mount(app)
+templating.precompile(app)